@@ -0,0 +1,119 @@
+# bench/fake_telegram.py
+
+"""Поддельный Telegram Bot API и генератор синтетических апдейтов.
+
+Сервер понимает ровно те методы, которые вызывает бот, и записывает момент
+каждого исходящего сообщения, чтобы бенчмарк мог посчитать задержку ответа.
+"""
+
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 777, "is_bot": True, "first_name": "Ибрагим", "username": "ibragim_bench_bot"}
+NAMES = ("Пётр", "Лёха", "Дмитрий", "bamboo", "Игорь")
+
+# Значения строковых полей PTB передаёт как есть, остальные — в JSON
+RAW_FIELDS = {"text", "action"}
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отвечает на вызовы бота и ведёт журнал отправленного."""
+
+    def __init__(self, on_message=None):
+        self.on_message = on_message
+        self.calls = {}
+        self._message_ids = itertools.count(10_000_000)
+        self._runner = None
+
+    @staticmethod
+    def _decode(form) -> dict:
+        params = {}
+        for key, value in form.items():
+            if key in RAW_FIELDS:
+                params[key] = value
+                continue
+            try:
+                params[key] = json.loads(value)
+            except (TypeError, ValueError):
+                params[key] = value
+        return params
+
+    def _message(self, params, message_id=None) -> dict:
+        chat_id = params["chat_id"]
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"group {chat_id}"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = self._decode(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params, params.get("message_id"))
+            if self.on_message is not None:
+                self.on_message(method, params, time.perf_counter())
+        elif method in ("sendChatAction", "deleteWebhook", "setWebhook", "setMyCommands"):
+            result = True
+        elif method == "getUpdates":
+            result = []
+        else:
+            return web.json_response({"ok": False, "error_code": 400, "description": f"Unknown method {method}"}, status=400)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        """Запускает сервер и возвращает base_url для Application.builder().base_url()."""
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class UpdateFactory:
+    """Собирает JSON апдейтов групповых сообщений в формате Bot API."""
+
+    def __init__(self, bot_username: str, admin_id: int):
+        self.bot_username = bot_username
+        self.admin_id = admin_id
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, chat_id: int, text: str, user_id: int = None, first_name: str = None) -> dict:
+        user_id = user_id if user_id is not None else 1000 + next(self._message_ids) % len(NAMES)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group", "title": f"group {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name or NAMES[user_id % len(NAMES)]},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def chatter(self, chat_id: int, mention: bool = False) -> dict:
+        text = "ну что там по кино на вечер?"
+        if mention:
+            text = f"{self.bot_username} {text}"
+        return self.message(chat_id, text)
+
+    def command(self, chat_id: int, command: str) -> dict:
+        return self.message(chat_id, f"/{command}", user_id=self.admin_id, first_name="bamboo")
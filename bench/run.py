@@ -0,0 +1,327 @@
+# bench/run.py
+
+"""Офлайн-бенчмарк бота на локальных заглушках Telegram и Groq.
+
+Сеть не нужна: бот ходит в поддельный Bot API и заглушку Groq на 127.0.0.1,
+апдейты генерируются синтетически и подаются прямо в очередь приложения.
+
+Запуск из корня репозитория:
+    python -m bench.run --scenario mentions --groups 50 --rate 1 --duration 30
+    python -m bench.run --scenario burst --groups 20 --burst 5
+    python -m bench.run --scenario idle --groups 100
+    python -m bench.run --scenario memory --groups 2000 --messages 50
+    python -m bench.run --scenario mentions --tail-rate 0.1 --no-hedge  # сравнить с хеджированием
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.fake_telegram import FakeTelegram, UpdateFactory
+from bench.stub_groq import StubGroq
+
+ADMIN_ID = 1
+BOT_USERNAME = "@ibragim_bench_bot"
+SCENARIOS = ("mentions", "commands", "burst", "idle", "memory")
+LARGE_MODEL = "bench-large"
+SMALL_MODEL = "bench-small"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mentions")
+    parser.add_argument("--groups", type=int, default=20, help="число групп")
+    parser.add_argument("--rate", type=float, default=1.0, help="сообщений в секунду на группу")
+    parser.add_argument("--duration", type=float, default=20.0, help="длительность нагрузки, с")
+    parser.add_argument("--mention-ratio", type=float, default=0.3, help="доля сообщений с упоминанием бота")
+    parser.add_argument("--burst", type=int, default=5, help="упоминаний подряд в сценарии burst")
+    parser.add_argument("--messages", type=int, default=50, help="сообщений на группу в сценарии memory")
+    parser.add_argument("--drain", type=float, default=30.0, help="сколько ждать ответов после нагрузки, с")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="задержка заглушки Groq до первого токена, с")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="задержка заглушки Groq на токен, с")
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 от заглушки Groq")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="доля ответов заглушки Groq в разы медленнее обычных")
+    parser.add_argument("--tail-factor", type=float, default=10.0, help="во сколько раз медленнее хвостовой ответ")
+    parser.add_argument("--small-model-latency", type=float, default=0.15, help="задержка до первого токена запасной модели, с")
+    parser.add_argument("--no-hedge", action="store_true", help="выключить хеджирование запросов к Groq")
+    parser.add_argument("--no-stream", action="store_true", help="выключить потоковые ответы бота")
+    parser.add_argument("--real-quotas", action="store_true", help="оставить боевые лимиты Groq и Telegram")
+    parser.add_argument("--output", help="дописать отчёт в файл")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args(argv)
+
+
+def configure_env(args, state_dir: str, groq_url: str, telegram_url: str):
+    """Настраивает бота через окружение; вызывается до импорта модуля bot."""
+    env = {
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "GROQ_API_KEY": "bench",
+        "ADMIN_ID": str(ADMIN_ID),
+        "BOT_USERNAME": BOT_USERNAME,
+        "TELEGRAM_BASE_URL": telegram_url,
+        "GROQ_BASE_URL": groq_url,
+        "STATE_DB_PATH": os.path.join(state_dir, "state.db"),
+        "STREAM_REPLIES": "0" if args.no_stream else "1",
+        "METRICS_LOG_INTERVAL": "3600",
+        "GROQ_MODELS": f"{LARGE_MODEL},{SMALL_MODEL}",
+        "GROQ_HEDGING": "0" if args.no_hedge else "1",
+    }
+    if not args.real_quotas:
+        env.update({
+            "GROQ_RPM": "1000000",
+            "GROQ_TPM": "1000000000",
+            "TELEGRAM_GROUP_PER_MINUTE": "1000000",
+            "TELEGRAM_GLOBAL_PER_SECOND": "1000000",
+        })
+    if args.scenario == "idle":
+        env.update({"CHIME_IN_DELAY": "1", "FOUR_HOUR_JOKE_DELAY": "3"})
+    if args.scenario == "memory":
+        # Сводки сразу, без паузы между ними: проверяем, что лимит кэша держится и под ними
+        env.update({"SUMMARY_MIN_INTERVAL": "0"})
+    os.environ.update(env)
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ReplyTracker:
+    """Сопоставляет входящие апдейты с ответами бота и считает задержку до первого видимого текста.
+
+    Ответ на сообщение закрывает и все более ранние ожидающие сообщения того же
+    чата: бот склеивает упоминания и отвечает на последнее из них.
+    """
+
+    def __init__(self):
+        self.waiting = {}
+        self.latencies = []
+        self.coalesced = 0
+        self.unsolicited = 0
+        self.edits = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(messages) for messages in self.waiting.values())
+
+    def expect(self, chat_id: int, message_id: int):
+        self.waiting.setdefault(chat_id, {})[message_id] = time.perf_counter()
+
+    def on_message(self, method: str, params: dict, now: float):
+        if method == "editMessageText":
+            self.edits += 1
+            return
+        reply_to = (params.get("reply_parameters") or {}).get("message_id")
+        waiting = self.waiting.get(params["chat_id"], {})
+        if reply_to not in waiting:
+            # Хвост длинного ответа или сообщение фоновой задачи
+            self.unsolicited += 1
+            return
+        for message_id in [m for m in waiting if m <= reply_to]:
+            self.latencies.append(now - waiting.pop(message_id))
+            if message_id != reply_to:
+                self.coalesced += 1
+
+
+class LoopLagMonitor:
+    """Меряет, насколько позже положенного просыпается короткий sleep — задержку event loop."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def inject(application, tracker: ReplyTracker, data: dict, expect_reply: bool):
+    from telegram import Update
+
+    if expect_reply:
+        tracker.expect(data["message"]["chat"]["id"], data["message"]["message_id"])
+    await application.update_queue.put(Update.de_json(data, application.bot))
+
+
+async def group_traffic(application, tracker, factory, chat_id, args, deadline):
+    """Поток сообщений одной группы с пуассоновскими интервалами."""
+    injected = 0
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(random.expovariate(args.rate))
+        if args.scenario == "commands":
+            await inject(application, tracker, factory.command(chat_id, random.choice(("movie", "joke"))), True)
+        elif args.scenario == "burst":
+            for _ in range(args.burst):
+                await inject(application, tracker, factory.chatter(chat_id, mention=True), True)
+            injected += args.burst - 1
+        else:
+            mention = random.random() < args.mention_ratio
+            await inject(application, tracker, factory.chatter(chat_id, mention=mention), mention)
+        injected += 1
+    return injected
+
+
+async def wait_for(predicate, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and not predicate():
+        await asyncio.sleep(0.1)
+
+
+async def run_memory(bot, args) -> tuple:
+    """Меряет память на чат и проверяет, что кэш контекстов держит лимит после фоновых сводок."""
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    text = "короче, вчера пересмотрел Бойцовский клуб и теперь не могу спать, это нормально?"
+    for i in range(args.groups):
+        chat_id = -1_000_000 - i
+        for _ in range(args.messages):
+            bot.remember(chat_id, bot.Role.USER, text, author="Пётр")
+    # Чаты со сводкой в работе не вытесняются — ждём, пока все сводки допишутся
+    await wait_for(lambda: not bot._background_tasks, args.drain)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cache = bot.chat_contexts
+    per_chat = (current - baseline) / max(1, len(cache))
+    cap_held = len(cache) <= cache.max_chats and cache.total_bytes <= cache.max_bytes
+    return cap_held, [
+        f"chats in memory: {len(cache)} of {args.groups}, cap {cache.max_chats} "
+        f"{'held' if cap_held else 'EXCEEDED'} (evicted {cache.evictions}, "
+        f"accounted {cache.total_bytes / 1024 / 1024:.1f} MiB, summaries left {len(bot._background_tasks)})",
+        f"messages per chat kept: {sum(len(c) for c in bot.chat_contexts.values()) / max(1, len(bot.chat_contexts)):.1f}",
+        f"memory per chat: {per_chat / 1024:.1f} KiB (peak total {peak / 1024 / 1024:.1f} MiB)",
+    ]
+
+
+async def main(args) -> tuple:
+    """Прогоняет сценарий; возвращает отчёт и признак того, что проверки сценария прошли."""
+    groq = StubGroq(
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        model_latency={SMALL_MODEL: args.small_model_latency},
+        tail_rate=args.tail_rate,
+        tail_factor=args.tail_factor,
+    )
+    tracker = ReplyTracker()
+    telegram = FakeTelegram(on_message=tracker.on_message)
+    groq_url = await groq.start()
+    telegram_url = await telegram.start()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        configure_env(args, state_dir, groq_url, telegram_url)
+        import bot
+
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+
+        application = bot.build_application()
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+
+        chat_ids = [-1_000_000 - i for i in range(args.groups)]
+        for chat_id in chat_ids:
+            bot.set_chat_active(chat_id, True)
+        # Пулы /movie и /joke прогреваются на старте, ждём, чтобы не мешали замерам
+        await wait_for(lambda: not (bot.movie_pool.refilling or bot.joke_pool.refilling), 30)
+        groq.requests = 0
+        groq.by_model = {}
+
+        lag = LoopLagMonitor()
+        lag.start()
+        started = time.perf_counter()
+        lines = [
+            f"scenario={args.scenario} groups={args.groups} rate={args.rate}/s duration={args.duration}s "
+            f"stream={not args.no_stream} groq_latency={args.first_token_latency}s+{args.token_latency}s/token "
+            f"error_rate={args.error_rate} tail_rate={args.tail_rate}x{args.tail_factor} hedging={not args.no_hedge}"
+        ]
+
+        ok = True
+        if args.scenario == "memory":
+            ok, memory_lines = await run_memory(bot, args)
+            lines.extend(memory_lines)
+            injected = 0
+        elif args.scenario == "idle":
+            factory = UpdateFactory(BOT_USERNAME, ADMIN_ID)
+            for chat_id in chat_ids:
+                await inject(application, tracker, factory.chatter(chat_id), False)
+            # chime_in через 1 с и шутка через 3 с тишины на каждую группу
+            await wait_for(lambda: tracker.unsolicited >= 2 * args.groups, args.drain)
+            injected = args.groups
+        else:
+            factory = UpdateFactory(BOT_USERNAME, ADMIN_ID)
+            deadline = started + args.duration
+            counts = await asyncio.gather(*(
+                group_traffic(application, tracker, factory, chat_id, args, deadline) for chat_id in chat_ids
+            ))
+            injected = sum(counts)
+            await wait_for(lambda: not tracker.pending, args.drain)
+
+        elapsed = time.perf_counter() - started
+        await lag.stop()
+
+        latencies = tracker.latencies
+        if injected:
+            lines.append(f"updates injected: {injected} ({injected / elapsed:.1f}/s over {elapsed:.1f}s)")
+        if latencies:
+            lines.append(f"answered updates: {len(latencies)} ({len(latencies) / elapsed:.1f}/s)")
+            lines.append(
+                "reply latency (first visible text): "
+                f"p50={percentile(latencies, 0.5) * 1000:.0f}ms p95={percentile(latencies, 0.95) * 1000:.0f}ms "
+                f"p99={percentile(latencies, 0.99) * 1000:.0f}ms max={max(latencies) * 1000:.0f}ms"
+            )
+        if args.scenario not in ("memory", "idle"):
+            lines.append(f"answered by a coalesced reply: {tracker.coalesced}, still unanswered: {tracker.pending}")
+        lines.append(f"unsolicited messages (idle jobs): {tracker.unsolicited}, message edits: {tracker.edits}")
+        if lag.samples:
+            lines.append(
+                f"event loop lag: p50={percentile(lag.samples, 0.5) * 1000:.1f}ms "
+                f"p99={percentile(lag.samples, 0.99) * 1000:.1f}ms max={max(lag.samples) * 1000:.1f}ms"
+            )
+        lines.append(
+            f"groq stub: requests={groq.requests} 429s={groq.rate_limited} max_in_flight={groq.max_in_flight} "
+            f"abandoned={groq.abandoned} by_model={groq.by_model}"
+        )
+        lines.append(f"telegram calls: {dict(sorted(telegram.calls.items()))}")
+        lines.append(f"bot metrics: {bot.metrics.summary()}")
+
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+    await telegram.stop()
+    await groq.stop()
+    return "\n".join(lines), ok
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report, ok = asyncio.run(main(args))
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(report + "\n\n")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,157 @@
+# bench/stub_groq.py
+
+"""Локальная заглушка OpenAI/Groq-совместимого API chat completions.
+
+Отвечает с настраиваемой задержкой, умеет потоковый режим (SSE) и с заданной
+вероятностью возвращает 429, чтобы проверить поведение бота на исчерпанной квоте.
+Задержку можно задать отдельно для модели и добавить редкие «хвостовые» ответы,
+в разы медленнее обычных, — на них проверяется хеджирование запросов.
+"""
+
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+WORDS = (
+    "слушай", "братан", "короче", "кино", "шаверма", "кандибобер", "пельмени",
+    "крыша", "айфон", "котики", "сарказм", "пицца", "рок", "Пётр", "мемы",
+)
+
+
+class StubGroq:
+    """Заглушка Groq: задержка до первого токена, задержка на токен, доля 429 и доля медленных ответов."""
+
+    def __init__(
+        self,
+        first_token_latency=0.3,
+        token_latency=0.005,
+        completion_tokens=60,
+        error_rate=0.0,
+        retry_after=1,
+        model_latency=None,
+        tail_rate=0.0,
+        tail_factor=10.0,
+    ):
+        self.first_token_latency = first_token_latency
+        self.model_latency = model_latency or {}
+        self.tail_rate = tail_rate
+        self.tail_factor = tail_factor
+        self.token_latency = token_latency
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.by_model = {}
+        self.abandoned = 0
+        self._runner = None
+
+    def _tokens(self):
+        return [random.choice(WORDS) + " " for _ in range(self.completion_tokens)]
+
+    @staticmethod
+    def _usage(body, completion_tokens):
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 3
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        try:
+            body = await request.json()
+        except ConnectionResetError:
+            # Бот отменил запрос, не дописав его (например, при остановке)
+            self.abandoned += 1
+            return web.Response(status=499)
+        self.requests += 1
+        model = body.get("model", "stub")
+        self.by_model[model] = self.by_model.get(model, 0) + 1
+        if random.random() < self.error_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after": str(self.retry_after)},
+            )
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            created = int(time.time())
+            tokens = self._tokens()
+            first_token_latency = self.model_latency.get(model, self.first_token_latency)
+            if random.random() < self.tail_rate:
+                first_token_latency *= self.tail_factor
+            await asyncio.sleep(first_token_latency)
+
+            if not body.get("stream"):
+                await asyncio.sleep(self.token_latency * len(tokens))
+                return web.json_response({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": self._usage(body, len(tokens)),
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            try:
+                await response.prepare(request)
+            except ConnectionResetError:
+                self.abandoned += 1
+                return response
+
+            def chunk(delta, finish_reason=None, **extra):
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                    **extra,
+                }
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+            try:
+                await response.write(chunk({"role": "assistant", "content": ""}))
+                for token in tokens:
+                    await response.write(chunk({"content": token}))
+                    await asyncio.sleep(self.token_latency)
+                await response.write(chunk({}, "stop", x_groq={"id": completion_id, "usage": self._usage(body, len(tokens))}))
+                await response.write(b"data: [DONE]\n\n")
+                await response.write_eof()
+            except ConnectionResetError:
+                # Клиент бросил поток: так бот отменяет проигравший хедж
+                self.abandoned += 1
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def start(self, host="127.0.0.1", port=0) -> str:
+        """Запускает сервер и возвращает base_url для клиента Groq."""
+        app = web.Application()
+        app.router.add_post("/openai/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
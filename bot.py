@@ -4,17 +4,30 @@ import logging
 import os
 import sys
 import asyncio
+import heapq
+import hmac
+import itertools
 import random
+import re
+import signal
+import sqlite3
+import threading
+import time
 from datetime import date
-from collections import deque
+from enum import IntEnum
+from collections import OrderedDict, defaultdict, deque
 from functools import wraps
 
+import httpx
+from aiohttp import web
 from dotenv import load_dotenv
-from groq import Groq
+from groq import APIConnectionError, AsyncGroq, InternalServerError, RateLimitError
 
-from telegram import Update
+from telegram import Message, ReplyParameters, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -28,6 +41,88 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+# Альтернативные адреса API (например, локальные заглушки для бенчмарков)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")
+
+# Параметры LLM-бэкенда
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "30"))
+
+# Модели по порядку: первая основная, следующие — запасные и цели хеджирования.
+# Элемент списка — "модель" или "модель@base_url", если модель живёт на другом адресе.
+GROQ_MODELS = os.getenv("GROQ_MODELS", f"{GROQ_MODEL},llama-3.1-8b-instant")
+# Хеджирование: если основная модель не ответила за перцентиль своей обычной задержки,
+# параллельно запрашиваем следующую модель и берём того, кто ответит первым
+GROQ_HEDGING = os.getenv("GROQ_HEDGING", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2.0"))
+# Повторы при 429/5xx/обрывах с экспоненциальной паузой и размыкатель на серию сбоев
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "2"))
+GROQ_RETRY_BASE_DELAY = float(os.getenv("GROQ_RETRY_BASE_DELAY", "0.5"))
+GROQ_RETRY_MAX_DELAY = float(os.getenv("GROQ_RETRY_MAX_DELAY", "8"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+# Квоты исходящего трафика: Groq (запросы и токены в минуту, у каждой модели свои) и Telegram
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "12000"))
+TELEGRAM_GROUP_PER_MINUTE = int(os.getenv("TELEGRAM_GROUP_PER_MINUTE", "20"))
+TELEGRAM_GLOBAL_PER_SECOND = int(os.getenv("TELEGRAM_GLOBAL_PER_SECOND", "30"))
+BACKGROUND_MAX_WAIT = float(os.getenv("BACKGROUND_MAX_WAIT", "60"))
+
+# Потоковые ответы: первое сообщение по первым токенам, дальше правки не чаще интервала
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "2.0"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Хранилище состояния чатов
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "ibragim_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2.0"))
+CONTEXT_MAX_MESSAGES = 50
+
+# Сколько контекстов держать в памяти; остальные лежат в хранилище и подгружаются по требованию
+MAX_CACHED_CHATS = int(os.getenv("MAX_CACHED_CHATS", "300"))
+CONTEXT_MEMORY_LIMIT = int(float(os.getenv("CONTEXT_MEMORY_LIMIT_MB", "32")) * 1024 * 1024)
+
+# Бюджет контекста: история держится в пределах бюджета токенов,
+# вытесненные сообщения сворачиваются в краткую сводку
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# Вытесненное сворачивается пачками: когда накопится четверть бюджета (но не чаще
+# SUMMARY_MIN_INTERVAL) или когда хвост пролежал SUMMARY_MAX_DELAY
+SUMMARY_FOLD_TOKENS = int(os.getenv("SUMMARY_FOLD_TOKENS", str(CONTEXT_TOKEN_BUDGET // 4)))
+SUMMARY_MIN_INTERVAL = float(os.getenv("SUMMARY_MIN_INTERVAL", "30"))
+SUMMARY_MAX_DELAY = float(os.getenv("SUMMARY_MAX_DELAY", "600"))
+
+# Заготовленные ответы для /movie и /joke
+RESPONSE_POOL_SIZE = int(os.getenv("RESPONSE_POOL_SIZE", "3"))
+RESPONSE_POOL_MAX_AGE = float(os.getenv("RESPONSE_POOL_MAX_AGE", "21600"))
+RESPONSE_POOL_REFILL_DELAY = float(os.getenv("RESPONSE_POOL_REFILL_DELAY", "5"))
+RESPONSE_POOL_RECENT = 30
+# Доля общих слов (по Жаккару), начиная с которой два ответа считаются повтором
+RESPONSE_POOL_SIMILARITY = float(os.getenv("RESPONSE_POOL_SIMILARITY", "0.5"))
+
+# Получение апдейтов: polling (по умолчанию) или webhook на aiohttp.
+# Без WEBHOOK_URL вебхук в Telegram не регистрируется — удобно для локальных тестов.
+# WEBHOOK_SECRET в режиме вебхука обязателен: без него апдейт может прислать кто угодно.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Метрики: Prometheus-эндпоинт (0 — выключен) и периодическая сводка в лог
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+# Таймеры тишины
+CHIME_IN_DELAY = float(os.getenv("CHIME_IN_DELAY", "600"))
+FOUR_HOUR_JOKE_DELAY = float(os.getenv("FOUR_HOUR_JOKE_DELAY", "21600")) # Пусть пока будет 6 часов, вместо 4 (14400)
 
 # --- Настройка логирования ---
 logging.basicConfig(
@@ -101,12 +196,1009 @@ SYSTEM_PROMPT = """
 - Держись стиля: кратко, остроумно, немного сарказма, тёплый тон для Бамбу и друзей.
 """
 
+# === Метрики ===
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как в Prometheus."""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль `q`."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class Metrics:
+    """Счётчики, гистограммы и датчики процесса с выдачей в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}
+        self._runner = None
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        self.counters[self._key(name, labels)] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        self.histograms[self._key(name, labels)].observe(value)
+
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(hist.BUCKETS, hist.counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._labels(labels, le)} {hist.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist.count}")
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        parts = []
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if hist.count:
+                label = ",".join(str(value) for _, value in labels)
+                parts.append(
+                    f"{name}[{label}] n={hist.count} avg={hist.sum / hist.count:.2f}s "
+                    f"p50<={hist.quantile(0.5)}s p95<={hist.quantile(0.95)}s"
+                )
+        totals = defaultdict(float)
+        for (name, _), value in self.counters.items():
+            totals[name] += value
+        parts.extend(f"{name}={value:g}" for name, value in sorted(totals.items()))
+        parts.extend(f"{name}={func()}" for name, func in sorted(self.gauges.items()))
+        return "; ".join(parts)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def start_server(self, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        logger.info(f"Metrics endpoint listening on 127.0.0.1:{port}/metrics")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = Metrics()
+
+def timed(name: str):
+    """Декоратор: пишет длительность обработчика в гистограмму ibragim_handler_seconds."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe("ibragim_handler_seconds", time.perf_counter() - started, handler=name)
+        return wrapped
+    return decorator
+
+# === Контекст чата ===
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: ~3 символа на токен плюс служебные токены сообщения."""
+    return len(text) // 3 + 4
+
+class Role(IntEnum):
+    USER = 0
+    ASSISTANT = 1
+
+ROLE_NAMES = {Role.USER: "user", Role.ASSISTANT: "assistant"}
+ROLES_BY_NAME = {name: role for role, name in ROLE_NAMES.items()}
+
+# Примерные накладные расходы на одно сообщение в памяти: объект со слотами и ячейка deque
+MESSAGE_OVERHEAD_BYTES = 120
+
+class ChatMessage:
+    """Компактная запись сообщения: роль — enum, имя автора интернировано."""
+
+    __slots__ = ("role", "author", "content", "tokens")
+
+    def __init__(self, role: Role, content: str, author: str = None):
+        self.role = role
+        self.author = sys.intern(author) if author else None
+        self.content = content
+        self.tokens = estimate_tokens(self.text)
+
+    @property
+    def text(self) -> str:
+        return f"{self.author}: {self.content}" if self.author else self.content
+
+    @property
+    def size(self) -> int:
+        return MESSAGE_OVERHEAD_BYTES + sys.getsizeof(self.content)
+
+    def to_dict(self) -> dict:
+        return {"role": ROLE_NAMES[self.role], "content": self.text}
+
+class ChatContext:
+    """История чата в пределах бюджета токенов со сводкой вытесненных сообщений.
+
+    Токены считаются один раз при добавлении сообщения. Сообщения, не влезшие
+    в бюджет, копятся в `evicted`, пока их не наберётся на пачку (`summary_due`),
+    и тогда фоновая задача сворачивает их в `summary` одним запросом.
+    """
+
+    __slots__ = (
+        "token_budget", "messages", "total_tokens", "size", "summary",
+        "evicted", "evicted_tokens", "folded_at", "summarizing",
+    )
+
+    def __init__(self, summary: str = "", token_budget: int = CONTEXT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self.messages = deque()
+        self.total_tokens = 0
+        self.size = 0
+        self.summary = summary
+        self.evicted = []
+        self.evicted_tokens = 0
+        self.folded_at = time.monotonic()
+        self.summarizing = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index) -> ChatMessage:
+        return self.messages[index]
+
+    def append(self, message: ChatMessage):
+        self.messages.append(message)
+        self.total_tokens += message.tokens
+        self.size += message.size
+        # Последнее сообщение остаётся всегда, даже если оно одно больше бюджета
+        while len(self.messages) > 1 and (
+            self.total_tokens > self.token_budget or len(self.messages) > CONTEXT_MAX_MESSAGES
+        ):
+            evicted = self.messages.popleft()
+            self.total_tokens -= evicted.tokens
+            self.size -= evicted.size
+            self.evicted.append(evicted)
+            self.evicted_tokens += evicted.tokens
+
+    def summary_due(self) -> bool:
+        if not self.evicted:
+            return False
+        elapsed = time.monotonic() - self.folded_at
+        return (self.evicted_tokens >= SUMMARY_FOLD_TOKENS and elapsed >= SUMMARY_MIN_INTERVAL) or (
+            elapsed >= SUMMARY_MAX_DELAY
+        )
+
+    def take_evicted(self) -> list:
+        evicted, self.evicted, self.evicted_tokens = self.evicted, [], 0
+        return evicted
+
+    def restore_evicted(self, evicted: list):
+        """Возвращает несвёрнутые сообщения в начало очереди."""
+        self.evicted[:0] = evicted
+        self.evicted_tokens += sum(message.tokens for message in evicted)
+
+    def to_messages(self) -> list:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Краткое содержание более ранней переписки в чате:\n{self.summary}"})
+        messages.extend(message.to_dict() for message in self.messages)
+        return messages
+
+class ChatCache:
+    """LRU-кэш контекстов с лимитом по числу чатов и примерному объёму памяти.
+
+    Вытесненный чат ничего не теряет: его история уже в хранилище и подгрузится
+    при следующем обращении. Чаты, по которым идёт генерация или сводка, не вытесняются,
+    поэтому по завершении такой работы лимит перепроверяется через `trim`.
+    """
+
+    def __init__(self, store, max_chats: int = MAX_CACHED_CHATS, max_bytes: int = CONTEXT_MEMORY_LIMIT):
+        self._store = store
+        self._contexts = OrderedDict()
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._contexts
+
+    def values(self):
+        return self._contexts.values()
+
+    def peek(self, chat_id: int):
+        return self._contexts.get(chat_id)
+
+    async def load(self, chat_id: int) -> ChatContext:
+        context = self._contexts.get(chat_id)
+        if context is not None:
+            self._contexts.move_to_end(chat_id)
+            return context
+        # Одновременные обращения к одному чату ждут одну загрузку
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.get_running_loop().create_task(self._load(chat_id))
+        return await asyncio.shield(loading)
+
+    def prefetch(self, chat_id: int):
+        """Подгружает контекст в фоне, не заставляя вызывающего ждать диск."""
+        if chat_id not in self._contexts and chat_id not in self._loading:
+            self._loading[chat_id] = spawn_background(self._load(chat_id))
+
+    async def _load(self, chat_id: int) -> ChatContext:
+        try:
+            context = await self._store.load_context(chat_id)
+        finally:
+            del self._loading[chat_id]
+        self._contexts[chat_id] = context
+        self.total_bytes += self._footprint(context)
+        if context.summary_due():
+            schedule_summary(chat_id, context)
+        self.trim()
+        return context
+
+    def grew(self, delta: int):
+        self.total_bytes += delta
+        if self.total_bytes > self.max_bytes:
+            self.trim()
+
+    def touch(self, chat_id: int):
+        if chat_id in self._contexts:
+            self._contexts.move_to_end(chat_id)
+
+    def demote(self, chat_id: int):
+        """Делает чат первым кандидатом на вытеснение, например когда бот в нём выключен."""
+        if chat_id in self._contexts:
+            self._contexts.move_to_end(chat_id, last=False)
+
+    @staticmethod
+    def _footprint(context: ChatContext) -> int:
+        return context.size + sys.getsizeof(context.summary)
+
+    @staticmethod
+    def _busy(chat_id: int, context: ChatContext) -> bool:
+        lane = chat_lanes.get(chat_id)
+        return context.summarizing or (lane is not None and lane.busy)
+
+    def _over_limit(self) -> bool:
+        return len(self._contexts) > self.max_chats or self.total_bytes > self.max_bytes
+
+    def trim(self):
+        """Вытесняет самые давние свободные чаты, пока кэш не уложится в лимиты."""
+        if not self._over_limit():
+            return
+        newest = next(reversed(self._contexts))
+        for chat_id in list(self._contexts):
+            if not self._over_limit():
+                break
+            context = self._contexts[chat_id]
+            # Только что запрошенный чат и чаты в работе не трогаем
+            if chat_id == newest or self._busy(chat_id, context):
+                continue
+            del self._contexts[chat_id]
+            chat_lanes.pop(chat_id, None)
+            self.total_bytes -= self._footprint(context)
+            self.evictions += 1
+
+# === Хранилище состояния ===
+
+class ChatStore:
+    """Состояние чатов в SQLite (WAL) с отложенной пакетной записью.
+
+    Обработчики только складывают изменения в буфер, на диск их сбрасывает
+    периодическая задача одной транзакцией в отдельном потоке.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._message_ops = []
+        self._active = {}
+        self._activity = {}
+        self._summaries = {}
+        self._unfolded = {}
+        self._unfolded_added = {}
+        # Сброс на диск и чтение контекста не пересекаются: так загрузка видит каждое
+        # сообщение либо в базе, либо в буфере, но не в пачке, которая пишется прямо сейчас
+        self._io_lock = asyncio.Lock()
+
+    def open(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                active INTEGER NOT NULL DEFAULT 0,
+                last_activity REAL,
+                summary TEXT NOT NULL DEFAULT '',
+                unfolded INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                author TEXT,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat_id, id);
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chats)")}
+        if "summary" not in columns:
+            self._conn.execute("ALTER TABLE chats ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+        if "unfolded" not in columns:
+            self._conn.execute("ALTER TABLE chats ADD COLUMN unfolded INTEGER NOT NULL DEFAULT 0")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if "author" not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN author TEXT")
+        self._conn.commit()
+
+    # --- Запись (только буфер, без обращения к диску) ---
+
+    def set_active(self, chat_id: int, active: bool):
+        self._active[chat_id] = active
+
+    def touch(self, chat_id: int, timestamp: float):
+        self._activity[chat_id] = timestamp
+
+    def set_summary(self, chat_id: int, summary: str):
+        self._summaries[chat_id] = summary
+
+    def set_unfolded(self, chat_id: int, count: int):
+        """Сколько сообщений перед окном контекста ещё не свёрнуто в сводку: их нельзя компактизировать."""
+        self._unfolded[chat_id] = count
+        self._unfolded_added.pop(chat_id, None)
+
+    def add_unfolded(self, chat_id: int, count: int = 1):
+        """Сообщение пришло, пока контекста нет в памяти: оно сдвинет окно, и кто-то из него выпадет несвёрнутым."""
+        self._unfolded_added[chat_id] = self._unfolded_added.get(chat_id, 0) + count
+
+    def append_message(self, chat_id: int, message: ChatMessage):
+        self._message_ops.append((chat_id, ROLE_NAMES[message.role], message.author, message.content))
+
+    # --- Сброс на диск ---
+
+    def _take_batch(self):
+        batch = (
+            self._message_ops, self._active, self._activity, self._summaries, self._unfolded, self._unfolded_added
+        )
+        self._message_ops, self._active, self._activity, self._summaries = [], {}, {}, {}
+        self._unfolded, self._unfolded_added = {}, {}
+        return batch
+
+    def _write(self, batch):
+        message_ops, active, activity, summaries, unfolded, unfolded_added = batch
+        with self._db_lock:
+            conn = self._conn
+            for chat_id, flag in active.items():
+                conn.execute(
+                    "INSERT INTO chats (chat_id, active) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET active = excluded.active",
+                    (chat_id, int(flag)),
+                )
+            for chat_id, timestamp in activity.items():
+                conn.execute(
+                    "INSERT INTO chats (chat_id, last_activity) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET last_activity = excluded.last_activity",
+                    (chat_id, timestamp),
+                )
+            for chat_id, summary in summaries.items():
+                conn.execute(
+                    "INSERT INTO chats (chat_id, summary) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary",
+                    (chat_id, summary),
+                )
+            for chat_id, count in unfolded.items():
+                conn.execute(
+                    "INSERT INTO chats (chat_id, unfolded) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET unfolded = excluded.unfolded",
+                    (chat_id, count),
+                )
+            for chat_id, count in unfolded_added.items():
+                conn.execute(
+                    "INSERT INTO chats (chat_id, unfolded) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET unfolded = unfolded + excluded.unfolded",
+                    (chat_id, count),
+                )
+            touched = set()
+            for chat_id, role, author, content in message_ops:
+                conn.execute(
+                    "INSERT INTO messages (chat_id, role, author, content) VALUES (?, ?, ?, ?)",
+                    (chat_id, role, author, content),
+                )
+                touched.add(chat_id)
+            # Компактизация: на диске держим то, что помещается в контекст, и ещё не свёрнутый хвост
+            for chat_id in touched:
+                conn.execute(
+                    "DELETE FROM messages WHERE chat_id = ? AND id NOT IN "
+                    "(SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ? + "
+                    "COALESCE((SELECT unfolded FROM chats WHERE chat_id = ?), 0))",
+                    (chat_id, chat_id, CONTEXT_MAX_MESSAGES, chat_id),
+                )
+            conn.commit()
+
+    async def flush(self):
+        async with self._io_lock:
+            if self._conn is None or not (
+                self._message_ops or self._active or self._activity or self._summaries
+                or self._unfolded or self._unfolded_added
+            ):
+                return
+            await asyncio.to_thread(self._write, self._take_batch())
+
+    def flush_sync(self):
+        if self._conn is None:
+            return
+        self._write(self._take_batch())
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.flush_sync()
+        with self._db_lock:
+            self._conn.close()
+        self._conn = None
+
+    # --- Чтение ---
+
+    def load_chats(self) -> list:
+        with self._db_lock:
+            return self._conn.execute("SELECT chat_id, active, last_activity FROM chats").fetchall()
+
+    def _read_context(self, chat_id: int):
+        with self._db_lock:
+            row = self._conn.execute("SELECT summary, unfolded FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            summary, unfolded = row if row else ("", 0)
+            rows = self._conn.execute(
+                "SELECT role, author, content FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, CONTEXT_MAX_MESSAGES + unfolded),
+            ).fetchall()
+        return summary, unfolded, rows[::-1]
+
+    async def load_context(self, chat_id: int) -> ChatContext:
+        """Собирает контекст из базы и ещё не сброшенного буфера; читает диск в отдельном потоке."""
+        async with self._io_lock:
+            summary, unfolded, rows = "", 0, []
+            if self._conn is not None:
+                summary, unfolded, rows = await asyncio.to_thread(self._read_context, chat_id)
+            # Дальше без await: буфер дочитывается в том же шаге цикла, что и вставка контекста в кэш
+            rows.extend(op[1:] for op in self._message_ops if op[0] == chat_id)
+            summary = self._summaries.get(chat_id, summary)
+            unfolded = self._unfolded.get(chat_id, unfolded) + self._unfolded_added.get(chat_id, 0)
+        context = ChatContext(summary)
+        for role, author, content in rows:
+            context.append(ChatMessage(ROLES_BY_NAME.get(role, Role.USER), content, author))
+        # Из не влезшего в бюджет несвёрнутыми остаются только последние `unfolded`,
+        # остальное уже отражено в сохранённой сводке
+        evicted = context.take_evicted()
+        if unfolded:
+            context.restore_evicted(evicted[-unfolded:])
+        self.set_unfolded(chat_id, len(context.evicted))
+        return context
+
 # --- Глобальные переменные для хранения состояния ---
 bot_active_chats = {}
-chat_contexts = {}
+chat_store = ChatStore(STATE_DB_PATH)
+chat_contexts = ChatCache(chat_store)
+
+async def get_context(chat_id: int) -> ChatContext:
+    """Возвращает контекст чата, при необходимости подгружая его из хранилища."""
+    return await chat_contexts.load(chat_id)
+
+def remember(chat_id: int, role: Role, content: str, author: str = None):
+    message = ChatMessage(role, content, author)
+    chat_store.append_message(chat_id, message)
+    context = chat_contexts.peek(chat_id)
+    if context is None:
+        # Контекста нет в памяти: сообщение уже в буфере хранилища, загрузка его подхватит.
+        # Пока бот в чате выключен, история копится только в хранилище
+        if bot_active_chats.get(chat_id):
+            chat_store.add_unfolded(chat_id)
+            chat_contexts.prefetch(chat_id)
+        return
+    if bot_active_chats.get(chat_id):
+        chat_contexts.touch(chat_id)
+    else:
+        chat_contexts.demote(chat_id)
+    size, unfolded = context.size, len(context.evicted)
+    context.append(message)
+    chat_contexts.grew(context.size - size)
+    if len(context.evicted) != unfolded:
+        chat_store.set_unfolded(chat_id, len(context.evicted))
+    if not context.summarizing and context.summary_due():
+        schedule_summary(chat_id, context)
+
+def set_chat_active(chat_id: int, active: bool):
+    bot_active_chats[chat_id] = active
+    chat_store.set_active(chat_id, active)
+
+# === Ограничение скорости ===
+
+class Priority(IntEnum):
+    """Приоритет исходящего запроса: чем меньше значение, тем раньше он обслуживается."""
+    MENTION = 0
+    COMMAND = 1
+    BACKGROUND = 2
+    EDIT = 3
+
+# Сколько можно ждать квоту; None — сколько потребуется. Промежуточные правки
+# потокового ответа либо проходят сразу, либо пропускаются.
+PRIORITY_MAX_WAIT = {
+    Priority.MENTION: None,
+    Priority.COMMAND: None,
+    Priority.BACKGROUND: BACKGROUND_MAX_WAIT,
+    Priority.EDIT: 0,
+}
+
+class RateLimited(Exception):
+    """Запрос отброшен: квота не освободилась за допустимое для его приоритета время."""
+
+class TokenBucket:
+    """Корзина токенов; может уходить в минус, когда фактический расход оказался больше оценки."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Через сколько секунд можно будет списать `amount` (больше ёмкости — по полной корзине)."""
+        self._refill()
+        return max(0.0, min(amount, self.capacity) - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds: float):
+        """Опустошает корзину так, чтобы она наполнилась не раньше чем через `seconds`."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class PriorityLimiter:
+    """Выдаёт квоту из набора корзин ожидающим по приоритету, а внутри приоритета — по очереди."""
+
+    def __init__(self):
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @staticmethod
+    def _delay(costs) -> float:
+        return max(bucket.delay(amount) for bucket, amount in costs)
+
+    @staticmethod
+    def _take(costs):
+        for bucket, amount in costs:
+            bucket.take(amount)
+
+    def _drop_cancelled(self):
+        while self._waiters and self._waiters[0][3].done():
+            heapq.heappop(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        self._drop_cancelled()
+        return not self._waiters
+
+    async def acquire(self, costs: list, priority: Priority) -> bool:
+        """Ждёт квоту `costs` — список пар (корзина, расход). False, если ждать пришлось бы слишком долго."""
+        self._drop_cancelled()
+        if not self._waiters and self._delay(costs) == 0:
+            self._take(costs)
+            return True
+        max_wait = PRIORITY_MAX_WAIT[priority]
+        if max_wait == 0:
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), costs, future))
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._pump())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+            return True
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return True
+            future.cancel()
+            return False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    def wake(self):
+        """Пересчитывает ожидание головы очереди — например, после возврата квоты в корзины."""
+        self._wakeup.set()
+
+    async def _pump(self):
+        while True:
+            self._drop_cancelled()
+            if not self._waiters:
+                return
+            costs, future = self._waiters[0][2], self._waiters[0][3]
+            delay = self._delay(costs)
+            if delay == 0:
+                heapq.heappop(self._waiters)
+                self._take(costs)
+                future.set_result(None)
+                continue
+            # Ждём квоту для головы очереди, но просыпаемся, если пришёл кто-то важнее
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+# Ниже этого числа групповые лимитеры не чистятся: проход по словарю дороже их памяти
+TELEGRAM_LIMITER_PRUNE_MIN = 256
+
+class TelegramRateLimiter(BaseRateLimiter[Priority]):
+    """Лимиты Bot API: общий на бота и отдельный на каждую группу.
+
+    Приоритет передаётся через `rate_limit_args` у методов бота. Лимитер группы
+    с полной корзиной и без ожидающих ничем не отличается от нового, поэтому такие
+    записи выбрасываются, когда словарь вырастает вдвое с прошлой чистки.
+    """
+
+    def __init__(self):
+        self._global_bucket = TokenBucket(TELEGRAM_GLOBAL_PER_SECOND, TELEGRAM_GLOBAL_PER_SECOND)
+        self._global = PriorityLimiter()
+        self._chats = {}
+        self._prune_at = TELEGRAM_LIMITER_PRUNE_MIN
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_limiter(self, chat_id):
+        limiter = self._chats.get(chat_id)
+        if limiter is None:
+            if len(self._chats) >= self._prune_at:
+                self._prune()
+            bucket = TokenBucket(TELEGRAM_GROUP_PER_MINUTE / 60, max(1, TELEGRAM_GROUP_PER_MINUTE // 4))
+            limiter = self._chats[chat_id] = (bucket, PriorityLimiter())
+        return limiter
+
+    def _prune(self):
+        # Корзина после паузы по RetryAfter уходит в минус и не считается полной — пауза сохранится
+        for chat_id, (bucket, limiter) in list(self._chats.items()):
+            if bucket.full and limiter.idle:
+                del self._chats[chat_id]
+        self._prune_at = max(TELEGRAM_LIMITER_PRUNE_MIN, 2 * len(self._chats))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args is not None else Priority.COMMAND
+        chat_id = data.get("chat_id")
+        chat_bucket = None
+        # Статус "печатает" не считается сообщением и групповой лимит не тратит
+        if chat_id is not None and endpoint != "sendChatAction":
+            chat_bucket, chat_limiter = self._chat_limiter(chat_id)
+            if not await chat_limiter.acquire([(chat_bucket, 1)], priority):
+                metrics.inc("ibragim_rate_limited_total", target="telegram", priority=priority.name)
+                raise RateLimited(f"{endpoint} to chat {chat_id} dropped by rate limiter")
+        if not await self._global.acquire([(self._global_bucket, 1)], priority):
+            metrics.inc("ibragim_rate_limited_total", target="telegram", priority=priority.name)
+            raise RateLimited(f"{endpoint} dropped by global rate limiter")
+
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = retry_after_seconds(e.retry_after)
+            metrics.inc("ibragim_telegram_retry_after_total")
+            logger.warning(f"Telegram flood control on {endpoint} for chat {chat_id}: retry after {retry_after}s")
+            # Пока запрос летел, запись группы могли вычистить: паузу ставим актуальной корзине
+            bucket = self._chat_limiter(chat_id)[0] if chat_bucket is not None else self._global_bucket
+            bucket.pause(retry_after)
+            if PRIORITY_MAX_WAIT[priority] is not None and retry_after > PRIORITY_MAX_WAIT[priority]:
+                raise
+            await asyncio.sleep(retry_after)
+            return await callback(*args, **kwargs)
+
+def retry_after_seconds(value) -> float:
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
 
 # --- API клиенты ---
-groq_client = Groq(api_key=GROQ_API_KEY)
+# Один пул соединений на весь процесс: keep-alive переиспользуется всеми чатами
+groq_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=GROQ_MAX_CONCURRENCY,
+        max_keepalive_connections=GROQ_MAX_CONCURRENCY,
+    ),
+    timeout=httpx.Timeout(GROQ_TIMEOUT, connect=10.0),
+)
+# Ограничение одновременных запросов к Groq, чтобы один чат не выбрал весь пул
+groq_semaphore = asyncio.Semaphore(GROQ_MAX_CONCURRENCY)
+
+# === Маршрутизация по моделям ===
+
+# Хеджируем только то, что ждёт живой человек; фоновым задачам лишний запрос не нужен
+HEDGE_PRIORITIES = (Priority.MENTION, Priority.COMMAND)
+# Сколько последних задержек модели помнить для расчёта порога хеджирования
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+class ModelUnavailable(Exception):
+    """Все модели выключены размыкателями: запрос не отправляется, чтобы не ждать заведомого сбоя."""
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев подряд; после паузы пропускает один пробный запрос."""
+
+    __slots__ = ("threshold", "cooldown", "failures", "opened_at", "probing")
+
+    def __init__(self, threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    @property
+    def ready(self) -> bool:
+        """Пропустит ли `allow()` запрос прямо сейчас (без захвата пробы)."""
+        if self.opened_at is None:
+            return True
+        return not self.probing and time.monotonic() - self.opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> bool:
+        """Учитывает сбой; возвращает True, если размыкатель только что разомкнулся."""
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+            self.probing = False
+            return True
+        return False
+
+    def abandon(self):
+        """Пробный запрос отменён, не дойдя до результата: следующий сможет попробовать снова."""
+        self.probing = False
+
+class GroqModel:
+    """Модель с клиентом своего адреса, размыкателем, окном недавних задержек и своей квотой.
+
+    Groq считает RPM/TPM и паузы после 429 отдельно для каждой модели, поэтому
+    корзины и очередь лимитера у каждой модели свои.
+    """
+
+    def __init__(self, name: str, client: AsyncGroq):
+        self.name = name
+        self.client = client
+        self.breaker = CircuitBreaker()
+        self.latencies = {"complete": deque(maxlen=LATENCY_WINDOW), "stream": deque(maxlen=LATENCY_WINDOW)}
+        self.request_bucket = TokenBucket(GROQ_RPM / 60, max(1, GROQ_RPM / 6))
+        self.token_bucket = TokenBucket(GROQ_TPM / 60, GROQ_TPM / 6)
+        self.limiter = PriorityLimiter()
+
+    def costs(self, tokens: int) -> list:
+        return [(self.request_bucket, 1), (self.token_bucket, tokens)]
+
+    def charge(self, tokens: int):
+        """Списывает квоту запроса сразу, без очереди: хедж или запасная модель нужны именно сейчас."""
+        for bucket, amount in self.costs(tokens):
+            bucket.take(amount)
+
+    def refund(self, tokens: int):
+        for bucket, amount in self.costs(tokens):
+            bucket.take(-amount)
+        self.limiter.wake()
+
+    def record_latency(self, mode: str, seconds: float):
+        self.latencies[mode].append(seconds)
+
+    def hedge_delay(self, mode: str) -> float:
+        """Порог хеджирования: перцентиль задержки (до первого токена в потоке, до ответа иначе)."""
+        samples = self.latencies[mode]
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(samples)
+        return max(HEDGE_MIN_DELAY, ordered[int(HEDGE_PERCENTILE * (len(ordered) - 1))])
+
+def parse_models(spec: str) -> list:
+    """Разбирает GROQ_MODELS; модели на одном адресе делят клиента и пул соединений."""
+    clients = {}
+    models = []
+    for item in spec.split(","):
+        name, _, base_url = item.strip().partition("@")
+        if not name:
+            continue
+        base_url = base_url or GROQ_BASE_URL
+        if base_url not in clients:
+            # Повторы делает маршрутизатор: ретраи SDK прятали бы 429 и сбивали учёт квоты
+            clients[base_url] = AsyncGroq(
+                api_key=GROQ_API_KEY,
+                base_url=base_url,
+                http_client=groq_http_client,
+                timeout=GROQ_TIMEOUT,
+                max_retries=0,
+            )
+        models.append(GroqModel(name, clients[base_url]))
+    return models
+
+class ModelRouter:
+    """Запускает запрос по списку моделей: хеджирует медленную, переходит к следующей при сбое.
+
+    `attempt(model)` выполняет запрос к одной модели. Победитель — первая успешная
+    попытка; остальные отменяются. Если успешными оказались сразу две, лишний
+    результат отдаётся в `discard`, чтобы закрыть поток.
+    """
+
+    def __init__(self, models: list):
+        if not models:
+            raise ValueError("GROQ_MODELS must list at least one model")
+        self.models = models
+
+    @property
+    def primary(self) -> GroqModel:
+        """Модель, на которую резервируется квота: первая, которую пропустит размыкатель."""
+        return next((model for model in self.models if model.breaker.ready), self.models[0])
+
+    async def race(self, attempt, mode: str, hedge: bool, first: GroqModel = None, on_launch=None, discard=None):
+        """Возвращает (модель, результат) первой успешной попытки.
+
+        Начинает с `first` (по умолчанию основной модели); `on_launch(model)` вызывается
+        перед запуском каждой попытки, чтобы списать квоту той модели, куда уходит запрос.
+        """
+        loop = asyncio.get_running_loop()
+        first = first or self.primary
+        queue = iter([first] + [model for model in self.models if model is not first])
+        pending = {}
+        last_error = None
+
+        async def with_slot(model):
+            # Хедж занимает свой слот семафора, пока не получит первый токен или не проиграет
+            async with groq_semaphore:
+                return await attempt(model)
+
+        def launch(hedging: bool = False) -> bool:
+            for model in queue:
+                if model.breaker.allow():
+                    if on_launch is not None:
+                        on_launch(model)
+                    task = loop.create_task(with_slot(model) if hedging else attempt(model))
+                    pending[task] = (model, loop.time())
+                    return True
+            return False
+
+        if not launch():
+            raise ModelUnavailable("all Groq models are switched off by circuit breakers")
+        hedge = hedge and GROQ_HEDGING and len(self.models) > 1
+        try:
+            while pending:
+                timeout = None
+                if hedge:
+                    model, launched = next(iter(pending.values()))
+                    timeout = max(0.0, launched + model.hedge_delay(mode) - loop.time())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Хеджируем один раз и только при свободном слоте: под нагрузкой дубли лишь удлинят очередь
+                    hedge = False
+                    if not groq_semaphore.locked() and launch(hedging=True):
+                        metrics.inc("ibragim_groq_hedged_total", model=first.name)
+                    continue
+                winner = None
+                for task in done:
+                    model, launched = pending.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    if winner is None:
+                        winner = model, task.result()
+                        model.record_latency(mode, loop.time() - launched)
+                    elif discard is not None:
+                        await discard(task.result())
+                if winner is not None:
+                    if winner[0] is not first:
+                        metrics.inc("ibragim_groq_fallback_wins_total", model=winner[0].name)
+                    return winner
+                # Все запущенные попытки упали: переходим к следующей модели
+                hedge = False
+                if not pending and not launch():
+                    break
+        finally:
+            for task, (model, launched) in pending.items():
+                task.cancel()
+                model.breaker.abandon()
+                # Проигравший медленнее победителя: учитываем это, иначе порог поползёт вниз
+                model.record_latency(mode, loop.time() - launched)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        raise last_error or ModelUnavailable("all Groq models are switched off by circuit breakers")
+
+model_router = ModelRouter(parse_models(GROQ_MODELS))
 
 # === Декораторы для проверки прав и условий ===
 
@@ -130,26 +1222,444 @@ def group_only(func):
 
 # === Функции для работы с API ===
 
-async def get_groq_response(chat_id: int) -> str:
-    if chat_id not in chat_contexts:
-        return "Что-то пошло не так с моим внутренним чатом."
+# Ожидаемая длина ответа для предварительного списания TPM; уточняется по usage
+GROQ_EXPECTED_COMPLETION_TOKENS = 256
 
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages.extend(list(chat_contexts[chat_id]))
+class GroqReservation:
+    """Квота, списанная авансом у модели, которой запрос уйдёт первым.
 
-    try:
-        chat_completion = groq_client.chat.completions.create(
+    `spent` ставит запрос, забравший резерв; до этого его можно вернуть через `groq_release`.
+    """
+
+    __slots__ = ("model", "estimate", "spent")
+
+    def __init__(self, model: GroqModel, estimate: int):
+        self.model = model
+        self.estimate = estimate
+        self.spent = False
+
+    def charge(self, model: GroqModel):
+        """Для `on_launch` маршрутизатора: хедж и запасные модели платят из своих корзин."""
+        if model is not self.model:
+            model.charge(self.estimate)
+
+async def groq_acquire(messages: list, max_tokens: int, priority: Priority) -> GroqReservation:
+    """Резервирует квоту основной модели Groq и возвращает резерв с числом списанных авансом токенов."""
+    estimate = sum(estimate_tokens(m["content"]) for m in messages)
+    estimate += min(max_tokens, GROQ_EXPECTED_COMPLETION_TOKENS)
+    model = model_router.primary
+    if not await model.limiter.acquire(model.costs(estimate), priority):
+        metrics.inc("ibragim_rate_limited_total", target="groq", priority=priority.name)
+        raise RateLimited(f"Groq request with priority {priority.name} dropped by rate limiter")
+    return GroqReservation(model, estimate)
+
+def groq_release(reservation: GroqReservation):
+    """Возвращает квоту, если запрос под неё так и не ушёл; повторный вызов ничего не делает."""
+    if reservation.spent:
+        return
+    reservation.spent = True
+    reservation.model.refund(reservation.estimate)
+
+async def groq_reserve(
+    chat_id: int, instruction: str = None, priority: Priority = Priority.COMMAND
+) -> GroqReservation:
+    """Резервирует квоту под ответ по контексту чата заранее.
+
+    Ожидание квоты не должно держать очередь чата: иначе упоминание в том же чате
+    стояло бы за фоновой задачей ещё до того, как попадёт в лимитер по приоритету.
+    """
+    return await groq_acquire(await build_prompt(chat_id, instruction), 1024, priority)
+
+def groq_account(model: GroqModel, estimate: int, usage, chat_id=None):
+    """Сверяет авансовое списание токенов модели с фактическим расходом из ответа Groq."""
+    if usage is None or not usage.total_tokens:
+        return
+    model.token_bucket.take(usage.total_tokens - estimate)
+    chat = chat_id if chat_id is not None else "none"
+    metrics.inc("ibragim_prompt_tokens_total", usage.prompt_tokens or 0, chat_id=chat)
+    metrics.inc("ibragim_completion_tokens_total", usage.completion_tokens or 0, chat_id=chat)
+
+def groq_retry_after(e: RateLimitError) -> float:
+    retry_after = e.response.headers.get("retry-after")
+    return float(retry_after) if retry_after else 60 / max(1, GROQ_RPM)
+
+def groq_throttled(e: RateLimitError, model: GroqModel):
+    seconds = groq_retry_after(e)
+    logger.warning(f"Groq rate limit hit on {model.name}, pausing its requests for {seconds}s")
+    model.request_bucket.pause(seconds)
+
+# Сбои, которые стоит повторить и которые говорят о нездоровье модели: квота, 5xx, обрывы, таймауты
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, asyncio.TimeoutError)
+
+def groq_failed(e: Exception, model: GroqModel):
+    metrics.inc("ibragim_groq_errors_total", error=type(e).__name__, model=model.name)
+    if isinstance(e, RateLimitError):
+        groq_throttled(e, model)
+    if not isinstance(e, RETRYABLE_ERRORS):
+        # Ошибка самого запроса (например, 400) о здоровье модели ничего не говорит
+        model.breaker.abandon()
+    elif model.breaker.failure():
+        metrics.inc("ibragim_groq_breaker_open_total", model=model.name)
+        logger.warning(f"Circuit breaker opened for Groq model {model.name} for {BREAKER_COOLDOWN}s")
+
+async def groq_call(model: GroqModel, request):
+    """Выполняет `request()` с таймаутом, повторяя 429/5xx с экспоненциальной паузой и разбросом."""
+    for attempt in itertools.count():
+        try:
+            result = await asyncio.wait_for(request(), timeout=GROQ_TIMEOUT)
+        except RETRYABLE_ERRORS as e:
+            groq_failed(e, model)
+            delay = min(GROQ_RETRY_MAX_DELAY, GROQ_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if isinstance(e, RateLimitError):
+                delay = max(delay, groq_retry_after(e))
+            # Долгую паузу не ждём: маршрутизатор быстрее ответит следующей моделью.
+            # После закрытия пула (остановка бота) повторять тоже нечего
+            if (
+                attempt >= GROQ_MAX_RETRIES
+                or delay > GROQ_RETRY_MAX_DELAY
+                or model.breaker.is_open
+                or groq_http_client.is_closed
+            ):
+                raise
+            metrics.inc("ibragim_groq_retries_total", model=model.name)
+            logger.warning(f"Groq model {model.name} failed with {type(e).__name__}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            # Повтор — ещё один запрос в счёт минутной квоты
+            model.request_bucket.take(1)
+        except Exception as e:
+            groq_failed(e, model)
+            raise
+        else:
+            model.breaker.success()
+            return result
+
+async def groq_complete(
+    messages: list,
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+    priority: Priority = Priority.COMMAND,
+    chat_id: int = None,
+    reserved: GroqReservation = None,
+) -> str:
+    """Неблокирующий запрос к Groq с учётом квот, ограничением параллельности и хеджированием.
+
+    `reserved` — квота, уже взятая через `groq_reserve`; тогда в лимитере запрос не ждёт.
+    """
+    reservation = reserved or await groq_acquire(messages, max_tokens, priority)
+    reservation.spent = True
+
+    async def attempt(model: GroqModel):
+        return await groq_call(model, lambda: model.client.chat.completions.create(
             messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.7,
-            max_tokens=1024,
+            model=model.name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        ))
+
+    async with groq_semaphore:
+        started = time.perf_counter()
+        model, chat_completion = await model_router.race(
+            attempt,
+            "complete",
+            priority in HEDGE_PRIORITIES,
+            first=reservation.model,
+            on_launch=reservation.charge,
+        )
+        metrics.observe("ibragim_groq_request_seconds", time.perf_counter() - started, mode="complete", model=model.name)
+    groq_account(model, reservation.estimate, chat_completion.usage, chat_id)
+    return chat_completion.choices[0].message.content
+
+def _chunk_text(chunk):
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+async def groq_stream(
+    messages: list,
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+    priority: Priority = Priority.COMMAND,
+    chat_id: int = None,
+    reserved: GroqReservation = None,
+):
+    """Потоковый запрос к Groq: отдаёт куски текста по мере генерации."""
+    reservation = reserved or await groq_acquire(messages, max_tokens, priority)
+    reservation.spent = True
+
+    async def attempt(model: GroqModel):
+        # Попытка длится до первого текста: по нему модели и соревнуются
+        stream = await groq_call(model, lambda: model.client.chat.completions.create(
+            messages=messages,
+            model=model.name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        ))
+        chunks = stream.__aiter__()
+        head = []
+        try:
+            while not head or not _chunk_text(head[-1]):
+                try:
+                    head.append(await asyncio.wait_for(chunks.__anext__(), timeout=GROQ_TIMEOUT))
+                except StopAsyncIteration:
+                    break
+        except asyncio.CancelledError:
+            await stream.close()
+            raise
+        except Exception as e:
+            groq_failed(e, model)
+            await stream.close()
+            raise
+        return stream, chunks, head
+
+    async def discard(result):
+        await result[0].close()
+
+    async with groq_semaphore:
+        started = time.perf_counter()
+        model, (stream, chunks, head) = await model_router.race(
+            attempt,
+            "stream",
+            priority in HEDGE_PRIORITIES,
+            first=reservation.model,
+            on_launch=reservation.charge,
+            discard=discard,
         )
-        response = chat_completion.choices[0].message.content
-        chat_contexts[chat_id].append({"role": "assistant", "content": response})
+        first_token = None
+        try:
+            head = iter(head)
+            while True:
+                chunk = next(head, None)
+                if chunk is None:
+                    try:
+                        # Таймаут на каждый кусок: зависший поток не держит слот семафора
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=GROQ_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                # Groq присылает расход токенов в последнем куске потока
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    groq_account(model, reservation.estimate, x_groq.usage, chat_id)
+                text = _chunk_text(chunk)
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        metrics.observe("ibragim_groq_first_token_seconds", first_token - started, model=model.name)
+                    yield text
+        except Exception as e:
+            groq_failed(e, model)
+            raise
+        finally:
+            await stream.close()
+        metrics.observe("ibragim_groq_request_seconds", time.perf_counter() - started, mode="stream", model=model.name)
+
+GROQ_ERROR_REPLY = "Так, у меня что-то с процессором... не могу сейчас сообразить. Попробуй позже."
+STREAM_TRUNCATED_MARK = " …(оборвалось)"
+
+async def build_prompt(chat_id: int, instruction: str = None) -> list:
+    """Собирает промпт по контексту чата; `instruction` добавляется разово и в историю не попадает."""
+    messages = (await get_context(chat_id)).to_messages()
+    if instruction:
+        messages.append({"role": "system", "content": instruction})
+    return messages
+
+# --- Сводка вытесненной истории ---
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткий конспект группового чата. Обнови сводку, добавив в неё новые сообщения. "
+    "Сохрани имена, факты о людях, договорённости и темы, которые могут всплыть позже. "
+    "Пиши сжато, без вступлений, не больше 150 слов."
+)
+
+_background_tasks = set()
+
+def spawn_background(coro):
+    """Запускает фоновую задачу и держит на неё ссылку, пока она не завершится."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def schedule_summary(chat_id: int, context: ChatContext):
+    """Запускает фоновое сворачивание вытесненных сообщений в сводку."""
+    context.summarizing = True
+    spawn_background(refresh_summary(chat_id, context))
+
+async def refresh_summary(chat_id: int, context: ChatContext):
+    try:
+        while context.summary_due():
+            evicted = context.take_evicted()
+            transcript = "\n".join(f"{ROLE_NAMES[m.role]}: {m.text}" for m in evicted)
+            messages = [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Текущая сводка:\n{context.summary or '(пусто)'}\n\nНовые сообщения:\n{transcript}"},
+            ]
+            try:
+                summary = await groq_complete(
+                    messages,
+                    temperature=0.3,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    priority=Priority.BACKGROUND,
+                    chat_id=chat_id,
+                )
+            except asyncio.CancelledError:
+                context.restore_evicted(evicted)
+                raise
+            except Exception as e:
+                # Не теряем сообщения: вернём их в очередь, следующая попытка — не раньше интервала
+                context.restore_evicted(evicted)
+                context.folded_at = time.monotonic()
+                logger.error(f"Summary refresh failed for chat {chat_id}: {e}")
+                return
+            context.folded_at = time.monotonic()
+            # Пока идёт сводка, чат не вытесняется из кэша, так что учёт памяти сходится
+            chat_contexts.grew(sys.getsizeof(summary) - sys.getsizeof(context.summary))
+            context.summary = summary
+            chat_store.set_summary(chat_id, context.summary)
+            chat_store.set_unfolded(chat_id, len(context.evicted))
+            logger.info(f"Summary refreshed for chat {chat_id}: {len(evicted)} messages folded")
+    finally:
+        context.summarizing = False
+        chat_contexts.trim()
+
+async def get_groq_response(
+    chat_id: int,
+    instruction: str = None,
+    remember_reply: bool = True,
+    priority: Priority = Priority.COMMAND,
+    reserved: GroqReservation = None,
+) -> str:
+    messages = await build_prompt(chat_id, instruction)
+
+    try:
+        response = await groq_complete(messages, priority=priority, chat_id=chat_id, reserved=reserved)
+        if remember_reply:
+            remember(chat_id, Role.ASSISTANT, response)
         return response
+    except asyncio.TimeoutError:
+        logger.error(f"Groq API timeout for chat {chat_id} after {GROQ_TIMEOUT}s")
+    except RateLimited as e:
+        logger.warning(f"Groq request for chat {chat_id} skipped: {e}")
     except Exception as e:
         logger.error(f"Groq API error: {e}")
-        return "Так, у меня что-то с процессором... не могу сейчас сообразить. Попробуй позже."
+    metrics.inc("ibragim_fallback_replies_total")
+    return GROQ_ERROR_REPLY
+
+async def send_reply(message: Message, text: str, priority: Priority = Priority.COMMAND) -> Message:
+    """Отвечает на сообщение через бота, чтобы передать лимитеру Telegram приоритет."""
+    return await message.get_bot().send_message(
+        message.chat_id,
+        text,
+        reply_parameters=ReplyParameters(message.message_id, allow_sending_without_reply=True),
+        rate_limit_args=priority,
+    )
+
+async def _edit_stream_message(sent: Message, text: str, shown: str, priority: Priority = Priority.EDIT) -> str:
+    """Обновляет растущее сообщение, возвращает текст, который теперь виден в чате."""
+    text = text[:TELEGRAM_MESSAGE_LIMIT]
+    if text == shown:
+        return shown
+    try:
+        await sent.get_bot().edit_message_text(
+            text, chat_id=sent.chat_id, message_id=sent.message_id, rate_limit_args=priority
+        )
+        return text
+    except RateLimited:
+        return shown
+    except RetryAfter as e:
+        logger.warning(f"Edit throttled by Telegram in chat {sent.chat_id}, retry after {e.retry_after}s")
+        return shown
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return text
+        raise
+
+async def stream_groq_reply(
+    message: Message,
+    chat_id: int,
+    instruction: str = None,
+    priority: Priority = Priority.COMMAND,
+    reserved: GroqReservation = None,
+) -> str:
+    """Отвечает на сообщение потоково: сразу отправляет первые токены и дописывает их правками."""
+    messages = await build_prompt(chat_id, instruction)
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    sent = None
+    last_edit = 0.0
+    complete = False
+    live = True
+
+    try:
+        async for delta in groq_stream(messages, priority=priority, chat_id=chat_id, reserved=reserved):
+            text += delta
+            now = loop.time()
+            if not live:
+                continue
+            # Сбой Telegram на промежуточном шаге не обрывает генерацию: дочитываем поток
+            # без правок, а итог отправим в конце
+            try:
+                if sent is None:
+                    if text.strip():
+                        sent = await send_reply(message, text, priority)
+                        shown, last_edit = text, now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                    shown = await _edit_stream_message(sent, text, shown)
+                    last_edit = loop.time()
+            except TelegramError as e:
+                logger.warning(f"Interim stream update failed in chat {chat_id}: {e}")
+                live = False
+        complete = True
+    except asyncio.TimeoutError:
+        logger.error(f"Groq API stream timeout for chat {chat_id} after {GROQ_TIMEOUT}s")
+    except RateLimited as e:
+        logger.warning(f"Groq stream for chat {chat_id} skipped: {e}")
+    except Exception as e:
+        logger.error(f"Groq API stream error: {e}")
+
+    if not text.strip():
+        metrics.inc("ibragim_fallback_replies_total")
+        response = GROQ_ERROR_REPLY
+        await send_reply(message, response, priority)
+        return response
+
+    if not complete:
+        # Начало ответа уже в чате: честно помечаем обрыв вместо того, чтобы выдать огрызок за ответ
+        metrics.inc("ibragim_truncated_replies_total")
+        text = text.rstrip() + STREAM_TRUNCATED_MARK
+
+    if sent is not None:
+        # Если дописать отправленное сообщение не вышло (его удалили, правку отбросил лимитер),
+        # ответ не теряем: отправляем его заново целиком
+        try:
+            shown = await _edit_stream_message(sent, text, shown, priority)
+        except TelegramError as e:
+            logger.warning(f"Final stream edit failed in chat {chat_id}, sending the reply anew: {e}")
+        if shown != text[:TELEGRAM_MESSAGE_LIMIT]:
+            sent = None
+    if sent is None:
+        sent = await send_reply(message, text[:TELEGRAM_MESSAGE_LIMIT], priority)
+    # Хвост длиннее лимита Telegram досылаем отдельными сообщениями
+    for start in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+        await send_reply(message, text[start:start + TELEGRAM_MESSAGE_LIMIT], priority)
+
+    # Оборванный ответ в историю не попадает: модель не должна считать его своей законченной репликой
+    if complete:
+        remember(chat_id, Role.ASSISTANT, text)
+    return text
+
+async def reply_with_groq(
+    message: Message,
+    chat_id: int,
+    instruction: str = None,
+    priority: Priority = Priority.COMMAND,
+    reserved: GroqReservation = None,
+) -> str:
+    """Генерирует ответ по контексту чата и отправляет его — потоково или целиком."""
+    if STREAM_REPLIES:
+        return await stream_groq_reply(message, chat_id, instruction, priority, reserved)
+    response = await get_groq_response(chat_id, instruction, priority=priority, reserved=reserved)
+    if response:
+        await send_reply(message, response, priority)
+    return response
 
 async def get_image_description(photo_file) -> str:
     """Заглушка для изображений"""
@@ -162,113 +1672,435 @@ async def get_image_description(photo_file) -> str:
     ]
     return random.choice(responses)
 
-# === Функции для Job Queue (авто-ответы) ===
+# === Очередь работы чатов ===
+
+class ChatLane:
+    """Сериализует генерации по контексту одного чата и копит упоминания бота.
+
+    Пока идёт генерация, новые упоминания не запускают свои запросы, а ждут
+    в `mentions` и получают один общий ответ следующим заходом.
+
+    Заходить в очередь нужно через `async with lane`: так учитываются и те, кто ещё
+    ждёт замка. Очередь с ожидающими нельзя выбросить из `chat_lanes`, иначе следующий
+    заход получил бы новую и пошёл параллельно с ними.
+    """
+
+    __slots__ = ("lock", "mentions", "draining", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.mentions = []
+        self.draining = False
+        self.users = 0
+
+    @property
+    def busy(self) -> bool:
+        return self.draining or self.users > 0
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self.lock.acquire()
+        except BaseException:
+            self.users -= 1
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.lock.release()
+        self.users -= 1
+
+chat_lanes = {}
+
+def get_lane(chat_id: int) -> ChatLane:
+    lane = chat_lanes.get(chat_id)
+    if lane is None:
+        lane = chat_lanes[chat_id] = ChatLane()
+    return lane
+
+@timed("answer_mentions")
+async def answer_mentions(chat_id: int, lane: ChatLane):
+    """Отвечает на накопленные упоминания, склеивая пришедшие во время генерации в один запрос."""
+    try:
+        while lane.mentions:
+            async with lane:
+                mentions, lane.mentions = lane.mentions, []
+                instruction = None
+                if len(mentions) > 1:
+                    names = ", ".join(dict.fromkeys(m.from_user.first_name for m in mentions if m.from_user))
+                    instruction = f"Тебя упомянули несколько раз подряд ({names}). Ответь всем одним сообщением."
+                    logger.info(f"Coalesced {len(mentions)} mentions in chat {chat_id}")
+                await mentions[-1].get_bot().send_chat_action(chat_id, 'typing', rate_limit_args=Priority.MENTION)
+                await reply_with_groq(mentions[-1], chat_id, instruction, Priority.MENTION)
+    finally:
+        lane.draining = False
+        chat_contexts.trim()
+
+# === Заготовленные ответы ===
+
+class ResponsePool:
+    """Пул заранее сгенерированных ответов на фиксированный промпт команды.
+
+    Команда забирает готовый ответ мгновенно, а пул пополняется в фоне,
+    когда Groq не занят живыми ответами. Устаревшие заготовки выбрасываются,
+    недавно выданные ответы не повторяются.
+
+    Повтор ищется по смыслу, а не по началу текста: модель каждый раз по-новому
+    начинает фразу. Если `titled`, ответы с названием в кавычках сравниваются по
+    названию («Начало» и "начало" — один фильм); остальные — по доле общих слов.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        prompt: str,
+        size: int = RESPONSE_POOL_SIZE,
+        max_age: float = RESPONSE_POOL_MAX_AGE,
+        titled: bool = False,
+    ):
+        self.name = name
+        self.prompt = prompt
+        self.size = size
+        self.max_age = max_age
+        self.titled = titled
+        self.items = deque()
+        self.recent = deque(maxlen=RESPONSE_POOL_RECENT)
+        self.refilling = False
+
+    _TITLE_RE = re.compile(r'[«"“„]([^«»"“”„\n]{2,80})[»"”“]')
+    _WORD_RE = re.compile(r"\w{3,}")
+
+    def _key(self, text: str) -> tuple:
+        """Ключ для поиска повторов: (нормализованное название или None, множество слов)."""
+        text = text.lower().replace("ё", "е")
+        title = None
+        if self.titled:
+            match = self._TITLE_RE.search(text)
+            if match:
+                title = " ".join(re.findall(r"\w+", match.group(1))) or None
+        return title, frozenset(self._WORD_RE.findall(text))
+
+    @staticmethod
+    def _same(a: tuple, b: tuple) -> bool:
+        if a[0] and b[0]:
+            return a[0] == b[0]
+        union = a[1] | b[1]
+        return bool(union) and len(a[1] & b[1]) / len(union) >= RESPONSE_POOL_SIMILARITY
+
+    def _seen(self, key: tuple, keys) -> bool:
+        return any(self._same(key, other) for other in keys)
+
+    def mark_served(self, text: str):
+        self.recent.append(self._key(text))
+
+    def take(self):
+        now = time.time()
+        while self.items:
+            created, text = self.items.popleft()
+            if now - created > self.max_age or self._seen(self._key(text), self.recent):
+                continue
+            self.mark_served(text)
+            return text
+        return None
+
+    def schedule_refill(self, delay: float = RESPONSE_POOL_REFILL_DELAY):
+        if not self.refilling and len(self.items) < self.size:
+            self.refilling = True
+            spawn_background(self._refill(delay))
+
+    async def _refill(self, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            attempts = 0
+            while len(self.items) < self.size and attempts < self.size * 2:
+                attempts += 1
+                # Живые ответы важнее: ждём, пока у Groq освободятся слоты
+                while groq_semaphore.locked():
+                    await asyncio.sleep(RESPONSE_POOL_REFILL_DELAY)
+                served = [self._key(text) for _, text in self.items]
+                served.extend(self.recent)
+                text = await groq_complete(
+                    [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": self.prompt}],
+                    temperature=1.0,
+                    priority=Priority.BACKGROUND,
+                )
+                if text and not self._seen(self._key(text), served):
+                    self.items.append((time.time(), text))
+            logger.info(f"Response pool '{self.name}' refilled: {len(self.items)}/{self.size}")
+        except Exception as e:
+            logger.error(f"Response pool '{self.name}' refill failed: {e}")
+        finally:
+            self.refilling = False
 
-def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
+MOVIE_PROMPT = "Посоветуй мне какой-нибудь крутой фильм. Можно боевик, триллер или комедию, или что-то со смыслом. Удиви меня."
+JOKE_PROMPT = "Расскажи смешную шутку или анекдот в своем стиле."
+
+movie_pool = ResponsePool("movie", MOVIE_PROMPT, titled=True)
+joke_pool = ResponsePool("joke", JOKE_PROMPT)
+
+async def reply_from_pool(message: Message, chat_id: int, pool: ResponsePool):
+    """Отвечает заготовкой из пула, а если пул пуст — живой генерацией."""
+    response = pool.take()
+    if response is not None:
+        async with get_lane(chat_id):
+            remember(chat_id, Role.USER, pool.prompt)
+            remember(chat_id, Role.ASSISTANT, response)
+            await message.reply_text(response)
+    else:
+        # Квота берётся до очереди чата, чтобы упоминания в нём не ждали лимитер за командой
+        reserved = await groq_reserve(chat_id, priority=Priority.COMMAND)
+        try:
+            async with get_lane(chat_id):
+                remember(chat_id, Role.USER, pool.prompt)
+                await message.chat.send_action('typing')
+                response = await reply_with_groq(message, chat_id, reserved=reserved)
+        finally:
+            # Если до запроса дело не дошло (сбой Telegram, отмена), квота возвращается
+            groq_release(reserved)
+        # Текст ошибки — не выданный ответ: он не должен отсеивать заготовки как повтор
+        if response != GROQ_ERROR_REPLY:
+            pool.mark_served(response)
+    pool.schedule_refill()
+
+# === Авто-ответы по тишине ===
+
+class IdleScheduler:
+    """Таймеры тишины для всех чатов на одной куче дедлайнов.
+
+    Сообщение в чате только обновляет метку последней активности. Единственная
+    фоновая задача спит до ближайшего дедлайна; если к этому моменту чат снова
+    ожил, запись переносится на новый срок вместо срабатывания.
+    """
+
+    def __init__(self):
+        self._actions = []
+        self._last_activity = {}
+        self._heap = []
+        self._pending = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._application = None
+
+    def add_action(self, delay: float, callback):
+        """Регистрирует действие `callback(bot, chat_id)` через `delay` секунд тишины."""
+        self._actions.append((delay, callback))
+
+    def _push(self, due: float, chat_id: int, index: int):
+        heapq.heappush(self._heap, (due, chat_id, index))
+        if self._heap[0][0] == due:
+            self._wakeup.set()
+
+    def touch(self, chat_id: int, timestamp: float):
+        self._last_activity[chat_id] = timestamp
+        for index, (delay, _) in enumerate(self._actions):
+            # Запись в куче уже есть — её перенесут при извлечении
+            if (chat_id, index) not in self._pending:
+                self._pending.add((chat_id, index))
+                self._push(timestamp + delay, chat_id, index)
+
+    def restore(self, chat_id: int, timestamp: float):
+        """Восстанавливает таймеры после рестарта; истёкшие, пока бот лежал, не запускаются."""
+        self._last_activity[chat_id] = timestamp
+        now = time.time()
+        for index, (delay, _) in enumerate(self._actions):
+            if timestamp + delay > now and (chat_id, index) not in self._pending:
+                self._pending.add((chat_id, index))
+                self._push(timestamp + delay, chat_id, index)
+
+    def forget(self, chat_id: int):
+        self._last_activity.pop(chat_id, None)
+
+    def last_activity(self, chat_id: int):
+        return self._last_activity.get(chat_id)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def start(self, application: Application):
+        self._application = application
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, chat_id, index = heapq.heappop(self._heap)
+                delay, callback = self._actions[index]
+                last_activity = self._last_activity.get(chat_id)
+                if last_activity is None:
+                    self._pending.discard((chat_id, index))
+                elif last_activity + delay > due:
+                    heapq.heappush(self._heap, (last_activity + delay, chat_id, index))
+                else:
+                    self._pending.discard((chat_id, index))
+                    self._application.create_task(callback(self._application.bot, chat_id))
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+async def _reserve_idle_reply(chat_id: int, instruction: str):
+    """Резервирует квоту под фоновую реплику вне очереди чата.
+
+    Пока фоновая задача ждёт лимитер, упоминания в том же чате обрабатываются без неё;
+    `None` — чат уже неактивен или квота так и не освободилась.
+    """
+    if not bot_active_chats.get(chat_id):
+        return None
+    try:
+        return await groq_reserve(chat_id, instruction, Priority.BACKGROUND)
+    except RateLimited as e:
+        logger.warning(f"Idle reply for chat {chat_id} skipped: {e}")
+        return None
+
+async def _chime_in_due(chat_id: int) -> bool:
+    context = await get_context(chat_id) if bot_active_chats.get(chat_id) else None
+    if not context or context[-1].role == Role.ASSISTANT:
+        logger.info(f"Chime-in job for chat {chat_id} skipped: last message was from the bot or chat is inactive.")
         return False
-    for job in current_jobs:
-        job.schedule_removal()
     return True
 
-async def chime_in(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    
-    if not bot_active_chats.get(chat_id) or not chat_contexts.get(chat_id) or chat_contexts[chat_id][-1]['role'] == 'assistant':
-        logger.info(f"Chime-in job for chat {chat_id} skipped: last message was from the bot or chat is inactive.")
+async def _send_idle_reply(bot, chat_id: int, prompt: str, response: str, activity):
+    """Отправляет фоновую реплику уже вне очереди чата и только после этого пишет её в историю.
+
+    Ожидание квоты Telegram на фоновом приоритете может тянуться до BACKGROUND_MAX_WAIT,
+    и упоминания в чате всё это время не должны стоять за ним. `activity` — метка последней
+    активности на момент генерации: если чат с тех пор ожил, реплика уже не к месту.
+    """
+    if not bot_active_chats.get(chat_id) or idle_scheduler.last_activity(chat_id) != activity:
+        logger.info(f"Idle reply for chat {chat_id} dropped: chat came alive while it was generated.")
         return
+    try:
+        await bot.send_message(chat_id, text=response, rate_limit_args=Priority.BACKGROUND)
+    except (RateLimited, RetryAfter) as e:
+        logger.warning(f"Idle reply for chat {chat_id} not sent: {e}")
+        return
+    remember(chat_id, Role.USER, prompt)
+    remember(chat_id, Role.ASSISTANT, response)
 
-    logger.info(f"Chime-in job triggered for chat {chat_id}")
+@timed("chime_in")
+async def chime_in(bot, chat_id: int):
+    if not await _chime_in_due(chat_id):
+        return
     prompt = "Прошло 10 минут тишины. Проанализируй последние сообщения и, если это уместно, вставь свою реплику, чтобы оживить диалог. Если обсуждать нечего, просто промолчи."
-    
-    chat_contexts[chat_id].append({"role": "user", "content": prompt})
-    response = await get_groq_response(chat_id)
-    
-    if response and "промолчи" not in response.lower():
-        await context.bot.send_message(chat_id, text=response)
-    else:
-        chat_contexts[chat_id].pop()
-        chat_contexts[chat_id].pop()
+    reserved = await _reserve_idle_reply(chat_id, prompt)
+    if reserved is None:
+        return
+    try:
+        async with get_lane(chat_id):
+            # Пока ждали квоту, бот мог уже ответить в чате или его могли выключить
+            if not await _chime_in_due(chat_id):
+                return
 
-async def four_hour_joke(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    chat_id = job.chat_id
-    if bot_active_chats.get(chat_id):
-        logger.info(f"4-hour joke job triggered for chat {chat_id}")
-        prompt = "В чате уже 6 часов мертвая тишина. Пора разрядить обстановку. Выдай остроумную шутку."
-        chat_contexts[chat_id].append({"role": "user", "content": prompt})
-        response = await get_groq_response(chat_id)
-        await context.bot.send_message(chat_id, text=response)
+            logger.info(f"Chime-in job triggered for chat {chat_id}")
+            activity = idle_scheduler.last_activity(chat_id)
+            # Промпт и ответ попадают в историю только если реплика действительно отправлена
+            response = await get_groq_response(
+                chat_id, instruction=prompt, remember_reply=False, priority=Priority.BACKGROUND, reserved=reserved
+            )
+    finally:
+        groq_release(reserved)
+    if not response or response == GROQ_ERROR_REPLY or "промолчи" in response.lower():
+        return
+    await _send_idle_reply(bot, chat_id, prompt, response, activity)
+
+@timed("four_hour_joke")
+async def four_hour_joke(bot, chat_id: int):
+    prompt = "В чате уже 6 часов мертвая тишина. Пора разрядить обстановку. Выдай остроумную шутку."
+    reserved = await _reserve_idle_reply(chat_id, prompt)
+    if reserved is None:
+        return
+    try:
+        async with get_lane(chat_id):
+            if not bot_active_chats.get(chat_id):
+                return
+            logger.info(f"4-hour joke job triggered for chat {chat_id}")
+            activity = idle_scheduler.last_activity(chat_id)
+            response = await get_groq_response(
+                chat_id, instruction=prompt, remember_reply=False, priority=Priority.BACKGROUND, reserved=reserved
+            )
+    finally:
+        groq_release(reserved)
+    # Фоновая шутка не стоит извинений в чат: при ошибке или нехватке квоты просто пропускаем
+    if not response or response == GROQ_ERROR_REPLY:
+        return
+    await _send_idle_reply(bot, chat_id, prompt, response, activity)
+
+idle_scheduler = IdleScheduler()
+idle_scheduler.add_action(CHIME_IN_DELAY, chime_in)
+idle_scheduler.add_action(FOUR_HOUR_JOKE_DELAY, four_hour_joke)
 
 # === Обработчики команд ===
 
+@timed("start_command")
 @admin_only
 @group_only
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    bot_active_chats[chat_id] = True
+    set_chat_active(chat_id, True)
     await update.message.reply_text("Ибрагим на связи! Погнали, братва! 🔥")
     logger.info(f"Bot started in chat {chat_id} by admin.")
 
+@timed("stop_command")
 @admin_only
 @group_only
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    bot_active_chats[chat_id] = False
-    remove_job_if_exists(f"chime_in_{chat_id}", context)
-    remove_job_if_exists(f"four_hour_joke_{chat_id}", context)
+    set_chat_active(chat_id, False)
+    idle_scheduler.forget(chat_id)
     await update.message.reply_text("Ладно, я пока помолчу. Если понадоблюсь - зови. /start")
     logger.info(f"Bot stopped in chat {chat_id} by admin.")
     
+@timed("disconnect_command")
 @admin_only
 @group_only
 async def disconnect_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Всё, я пошел на боковую. Отключаюсь...")
     logger.info("Disconnect command received. Shutting down.")
+    chat_store.close()
     # ИСПРАВЛЕНИЕ: Ждем 1 секунду, чтобы сообщение успело отправиться, и принудительно выходим
     await asyncio.sleep(1)
     os._exit(0)
 
+@timed("movie_command")
 @admin_only
 @group_only
 async def movie_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    # ИСПРАВЛЕНИЕ: Проверяем и создаем контекст, если его нет
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = deque(maxlen=20)
-        
+    # Контекст не трогаем до проверки: иначе чат с выключенным ботом читался бы с диска
+    # и занимал место в LRU. Когда он нужен, его подгрузит reply_from_pool
     if not bot_active_chats.get(chat_id):
         await update.message.reply_text("Сначала запусти меня командой /start")
         return
         
-    await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-    prompt = "Посоветуй мне какой-нибудь крутой фильм. Можно боевик, триллер или комедию, или что-то со смыслом. Удиви меня."
-    chat_contexts[chat_id].append({"role": "user", "content": prompt})
-    response = await get_groq_response(chat_id)
-    await update.message.reply_text(response)
+    await reply_from_pool(update.message, chat_id, movie_pool)
     
+@timed("joke_command")
 @admin_only
 @group_only
 async def joke_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    # ИСПРАВЛЕНИЕ: Проверяем и создаем контекст, если его нет
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = deque(maxlen=20)
-        
     if not bot_active_chats.get(chat_id):
         await update.message.reply_text("Сначала запусти меня командой /start")
         return
         
-    await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-    prompt = "Расскажи смешную шутку или анекдот в своем стиле."
-    chat_contexts[chat_id].append({"role": "user", "content": prompt})
-    response = await get_groq_response(chat_id)
-    await update.message.reply_text(response)
+    await reply_from_pool(update.message, chat_id, joke_pool)
 
 # === Основной обработчик сообщений ===
 
+@timed("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or update.message.chat.type == 'private':
         return
@@ -277,52 +2109,176 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text or update.message.caption or ""
     username = update.effective_user.first_name
 
-    if chat_id not in chat_contexts:
-        chat_contexts[chat_id] = deque(maxlen=20)
-
-    full_user_content = f"{username}: {message_text}"
-    chat_contexts[chat_id].append({"role": "user", "content": full_user_content})
+    remember(chat_id, Role.USER, message_text, author=username)
 
     if not bot_active_chats.get(chat_id):
         return
         
     if BOT_USERNAME in message_text:
-        await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-        response = ""
-
         if update.message.photo:
+            await context.bot.send_chat_action(chat_id=chat_id, action='typing')
             response = await get_image_description(None)
-            chat_contexts[chat_id].append({"role": "assistant", "content": response})
-        else:
-            response = await get_groq_response(chat_id)
-        
-        if response:
+            remember(chat_id, Role.ASSISTANT, response)
             await update.message.reply_text(response)
+        else:
+            # Генерация идёт в фоне: упоминания, пришедшие пока она не закончилась, склеятся
+            lane = get_lane(chat_id)
+            lane.mentions.append(update.message)
+            if not lane.draining:
+                lane.draining = True
+                context.application.create_task(answer_mentions(chat_id, lane), update=update)
+
+    now = time.time()
+    idle_scheduler.touch(chat_id, now)
+    chat_store.touch(chat_id, now)
+
+# --- Жизненный цикл приложения ---
+async def flush_state(context: ContextTypes.DEFAULT_TYPE):
+    await chat_store.flush()
+
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE):
+    logger.info(f"Metrics: {metrics.summary()}")
+
+async def post_init(application: Application) -> None:
+    """Поднимает сохранённое состояние и восстанавливает таймеры тишины."""
+    chat_store.open()
+    restored = 0
+    for chat_id, active, last_activity in chat_store.load_chats():
+        bot_active_chats[chat_id] = bool(active)
+        if not active or last_activity is None:
+            continue
+        idle_scheduler.restore(chat_id, last_activity)
+        restored += 1
+    idle_scheduler.start(application)
+    movie_pool.schedule_refill()
+    joke_pool.schedule_refill()
+
+    metrics.gauge("ibragim_chat_contexts", lambda: len(chat_contexts))
+    metrics.gauge("ibragim_context_messages", lambda: sum(len(c) for c in chat_contexts.values()))
+    metrics.gauge("ibragim_context_bytes", lambda: chat_contexts.total_bytes)
+    metrics.gauge("ibragim_context_evictions", lambda: chat_contexts.evictions)
+    metrics.gauge("ibragim_groq_breakers_open", lambda: sum(m.breaker.is_open for m in model_router.models))
+    metrics.gauge("ibragim_active_chats", lambda: sum(1 for active in bot_active_chats.values() if active))
+    metrics.gauge("ibragim_idle_timers", lambda: idle_scheduler.pending_count)
+    metrics.gauge("ibragim_scheduler_jobs", lambda: len(application.job_queue.jobs()))
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_PORT)
+    application.job_queue.run_repeating(log_metrics, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL)
+    application.job_queue.run_repeating(flush_state, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    logger.info(f"State restored from {STATE_DB_PATH}: {restored} active chats")
+
+async def cancel_background():
+    """Отменяет фоновые задачи; несвёрнутые сообщения остаются в хранилище до следующего запуска."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def post_shutdown(application: Application) -> None:
+    """Сбрасывает состояние на диск и закрывает пул соединений к Groq."""
+    await idle_scheduler.stop()
+    await metrics.stop_server()
+    # Фоновые запросы отменяем до закрытия пула, иначе они упадут с ошибкой соединения
+    # и разомкнут размыкатели моделей
+    await cancel_background()
+    chat_store.close()
+    await groq_http_client.aclose()
+
+# --- Webhook ---
+async def webhook_handler(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и ставит его в очередь приложения, не дожидаясь обработки."""
+    application = request.app[APPLICATION_KEY]
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # compare_digest на str падает на не-ASCII символах: сравниваем байты, чтобы любой мусор давал 403
+    if not hmac.compare_digest(token.encode(errors="replace"), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        logger.warning(f"Rejected malformed webhook update: {e}")
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+APPLICATION_KEY = web.AppKey("application", Application)
+
+def build_webhook_app(application: Application) -> web.Application:
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    return web_app
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме вебхука на встроенном сервере aiohttp.
+
+    Локальная проверка: BOT_MODE=webhook без WEBHOOK_URL, затем
+    curl -X POST localhost:8080/telegram -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
 
-    remove_job_if_exists(f"chime_in_{chat_id}", context)
-    remove_job_if_exists(f"four_hour_joke_{chat_id}", context)
-    context.job_queue.run_once(chime_in, 600, chat_id=chat_id, name=f"chime_in_{chat_id}")
-    context.job_queue.run_once(four_hour_joke, 21600, chat_id=chat_id, name=f"four_hour_joke_{chat_id}") # Пусть пока будет 6 часов, вместо 4 (14400)
+    runner = web.AppRunner(build_webhook_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 # --- Обработчик ошибок ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Логирует ошибки, вызванные апдейтами."""
+    metrics.inc("ibragim_handler_errors_total", error=type(context.error).__name__)
+    if isinstance(context.error, RateLimited):
+        logger.warning(f"Dropped by rate limiter: {context.error}")
+        return
     logger.error("Exception while handling an update:", exc_info=context.error)
 
 # === Точка входа ===
-def main():
-    """Запуск бота."""
-    if not all([TELEGRAM_BOT_TOKEN, GROQ_API_KEY, ADMIN_ID, BOT_USERNAME]):
-        logger.error("Ошибка: не все переменные окружения заданы в .env файле!")
-        sys.exit(1)
-
-    application = (
+def build_application() -> Application:
+    """Собирает приложение со всеми обработчиками, но не запускает его."""
+    builder = (
         Application.builder()
         .token(TELEGRAM_BOT_TOKEN)
         .connect_timeout(20.0)
         .read_timeout(20.0)
-        .build()
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .rate_limiter(TelegramRateLimiter())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
 
     application.add_error_handler(error_handler)
 
@@ -332,9 +2288,24 @@ def main():
     application.add_handler(CommandHandler("movie", movie_command))
     application.add_handler(CommandHandler("joke", joke_command))
     application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, handle_message))
+    return application
+
+def main():
+    """Запуск бота."""
+    if not all([TELEGRAM_BOT_TOKEN, GROQ_API_KEY, ADMIN_ID, BOT_USERNAME]):
+        logger.error("Ошибка: не все переменные окружения заданы в .env файле!")
+        sys.exit(1)
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        logger.error("Ошибка: в режиме webhook нужно задать WEBHOOK_SECRET!")
+        sys.exit(1)
+
+    application = build_application()
 
     logger.info("Бот Ибрагим запускается...")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
     logger.info("Бот Ибрагим остановлен.")
 
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# bot.py читает конфигурацию при импорте: задаём обязательные переменные до него
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123:test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("BOT_USERNAME", "ibragim_test_bot")
+os.environ.setdefault("GROQ_MODELS", "test-large,test-small")
+# retry_after как timedelta — формат следующих версий PTB; бот понимает оба
+os.environ.setdefault("PTB_TIMEDELTA", "1")
+os.environ.setdefault("STATE_DB_PATH", os.path.join(tempfile.mkdtemp(), "state.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,82 @@
+import asyncio
+
+import bot
+from bot import Role
+
+
+class FakeStore:
+    def __init__(self):
+        self.loads = 0
+
+    async def load_context(self, chat_id):
+        self.loads += 1
+        await asyncio.sleep(0)
+        context = bot.ChatContext()
+        context.append(bot.ChatMessage(Role.USER, f"hello from {chat_id}", "tester"))
+        return context
+
+
+def test_lru_cap_holds_and_evicts_oldest():
+    async def run():
+        cache = bot.ChatCache(FakeStore(), max_chats=3, max_bytes=1 << 30)
+        for chat_id in (-1, -2, -3):
+            await cache.load(chat_id)
+        # Обращение делает чат свежим: вытесняться должен -2
+        await cache.load(-1)
+        await cache.load(-4)
+        return cache
+
+    cache = asyncio.run(run())
+    assert len(cache) == 3
+    assert -2 not in cache
+    assert all(chat_id in cache for chat_id in (-1, -3, -4))
+    assert cache.evictions == 1
+
+
+def test_byte_limit_evicts_until_under_cap():
+    async def run():
+        cache = bot.ChatCache(FakeStore(), max_chats=100, max_bytes=1)
+        for chat_id in range(-1, -6, -1):
+            await cache.load(chat_id)
+        return cache
+
+    cache = asyncio.run(run())
+    # Только что загруженный чат остаётся, даже если сам не влезает в лимит
+    assert list(cache._contexts) == [-5]
+
+
+def test_busy_chat_survives_and_cap_is_rechecked():
+    async def run():
+        cache = bot.ChatCache(FakeStore(), max_chats=2, max_bytes=1 << 30)
+        await cache.load(-11)
+        await cache.load(-12)
+        async with bot.get_lane(-11):
+            await cache.load(-13)
+            # Вместо занятого чата вытесняется следующий свободный
+            assert -11 in cache and -12 not in cache
+            bot.get_lane(-13).draining = True
+            await cache.load(-14)
+            # Свободных больше нет: лимит временно превышен
+            assert len(cache) == 3
+        bot.get_lane(-13).draining = False
+        cache.trim()
+        return cache
+
+    try:
+        cache = asyncio.run(run())
+    finally:
+        bot.chat_lanes.clear()
+    assert len(cache) == 2
+    assert set(cache._contexts) == {-13, -14}
+
+
+def test_concurrent_loads_share_one_read():
+    store = FakeStore()
+
+    async def run():
+        cache = bot.ChatCache(store, max_chats=10, max_bytes=1 << 30)
+        first, second = await asyncio.gather(cache.load(-1), cache.load(-1))
+        return first is second
+
+    assert asyncio.run(run())
+    assert store.loads == 1
@@ -0,0 +1,116 @@
+import asyncio
+
+import bot
+from test_chat_cache import FakeStore
+
+
+def test_lane_with_waiters_survives_trim():
+    async def run():
+        cache = bot.ChatCache(FakeStore(), max_chats=1, max_bytes=1 << 30)
+        await cache.load(-21)
+        lane = bot.get_lane(-21)
+        entered = []
+
+        async def waiter():
+            async with bot.get_lane(-21):
+                entered.append(bot.chat_lanes.get(-21))
+
+        async with lane:
+            await cache.load(-22)
+            task = asyncio.create_task(waiter())
+            await asyncio.sleep(0)
+        # Замок только что отпущен, но ожидающий ещё не вошёл: чат всё равно занят
+        assert not lane.lock.locked() and lane.busy
+        cache.trim()
+        assert bot.chat_lanes.get(-21) is lane
+        await task
+        assert entered == [lane] and not lane.busy
+        cache.trim()
+        return cache
+
+    try:
+        cache = asyncio.run(run())
+    finally:
+        bot.chat_lanes.clear()
+    assert list(cache._contexts) == [-22]
+
+
+class FakeBot:
+    async def send_chat_action(self, *args, **kwargs):
+        pass
+
+
+class FakeUser:
+    def __init__(self, name):
+        self.first_name = name
+
+
+class FakeMessage:
+    def __init__(self, chat_id, author, text):
+        self.chat_id = chat_id
+        self.chat = type("Chat", (), {"type": "group"})()
+        self.from_user = FakeUser(author)
+        self.text = text
+        self.caption = None
+        self.photo = None
+
+    def get_bot(self):
+        return FakeBot()
+
+
+class FakeUpdate:
+    def __init__(self, message):
+        self.message = message
+        self.effective_user = message.from_user
+
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+def test_mentions_during_generation_get_one_reply(monkeypatch):
+    chat_id = -31
+    replies = []
+    generating = None
+
+    async def fake_reply(message, chat_id, instruction=None, priority=None):
+        replies.append((message.text, instruction))
+        await generating.wait()
+        return "ответ"
+
+    monkeypatch.setattr(bot, "reply_with_groq", fake_reply)
+    monkeypatch.setitem(bot.bot_active_chats, chat_id, True)
+    context = type("Context", (), {"application": FakeApplication(), "bot": FakeBot()})()
+
+    async def mention(author, text):
+        message = FakeMessage(chat_id, author, f"@{bot.BOT_USERNAME} {text}")
+        await bot.handle_message(FakeUpdate(message), context)
+
+    async def run():
+        nonlocal generating
+        generating = asyncio.Event()
+        await mention("Петя", "как дела?")
+        await asyncio.sleep(0)
+        # Пока первый ответ генерируется, приходят ещё два упоминания
+        await mention("Вася", "ты тут?")
+        await mention("Маша", "ау")
+        generating.set()
+        await asyncio.gather(*context.application.tasks)
+
+    try:
+        asyncio.run(run())
+    finally:
+        bot.chat_lanes.clear()
+
+    # Одна фоновая задача на всю серию, второй заход отвечает последнему сообщению за всех
+    assert len(context.application.tasks) == 1
+    assert len(replies) == 2
+    assert replies[0] == (f"@{bot.BOT_USERNAME} как дела?", None)
+    assert replies[1][0] == f"@{bot.BOT_USERNAME} ау"
+    assert "Вася, Маша" in replies[1][1]
@@ -0,0 +1,98 @@
+import asyncio
+
+import bot
+from bot import ChatMessage, Role
+
+
+def _store(tmp_path):
+    store = bot.ChatStore(str(tmp_path / "state.db"))
+    store.open()
+    return store
+
+
+def _unfolded(store, chat_id):
+    return store._conn.execute("SELECT unfolded FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+
+def test_state_survives_restart(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.set_active(-1, True)
+        store.touch(-1, 1700000000.0)
+        store.set_summary(-1, "Вася обещал пиццу")
+        store.append_message(-1, ChatMessage(Role.USER, "привет", "Вася"))
+        await store.flush()
+        # Несброшенный хвост дописывается при закрытии
+        store.append_message(-1, ChatMessage(Role.ASSISTANT, "здорово"))
+        store.close()
+
+        store = _store(tmp_path)
+        chats = store.load_chats()
+        context = await store.load_context(-1)
+        store.close()
+        return chats, context
+
+    chats, context = asyncio.run(run())
+    assert chats == [(-1, 1, 1700000000.0)]
+    assert context.summary == "Вася обещал пиццу"
+    assert [(m.role, m.author, m.content) for m in context] == [
+        (Role.USER, "Вася", "привет"),
+        (Role.ASSISTANT, None, "здорово"),
+    ]
+
+
+def test_load_merges_unflushed_buffer_without_duplicates(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.append_message(-2, ChatMessage(Role.USER, "раз"))
+        await store.flush()
+        store.append_message(-2, ChatMessage(Role.USER, "два"))
+        before = [m.content for m in await store.load_context(-2)]
+        await store.flush()
+        after = [m.content for m in await store.load_context(-2)]
+        store.close()
+        return before, after
+
+    assert asyncio.run(run()) == (["раз", "два"], ["раз", "два"])
+
+
+def test_compaction_keeps_window_and_unfolded_tail(tmp_path):
+    total = bot.CONTEXT_MAX_MESSAGES + 20
+
+    async def run():
+        store = _store(tmp_path)
+        for i in range(total):
+            store.append_message(-3, ChatMessage(Role.USER, f"m{i}"))
+        store.set_unfolded(-3, 5)
+        await store.flush()
+        rows = [row[0] for row in store._conn.execute("SELECT content FROM messages WHERE chat_id = -3 ORDER BY id")]
+        context = await store.load_context(-3)
+        store.close()
+        return rows, context
+
+    rows, context = asyncio.run(run())
+    # На диске окно контекста и пять ещё не свёрнутых в сводку сообщений перед ним
+    assert rows == [f"m{i}" for i in range(15, total)]
+    assert len(context) == bot.CONTEXT_MAX_MESSAGES
+    assert [m.content for m in context.evicted] == [f"m{i}" for i in range(15, 20)]
+
+
+def test_unfolded_count_accumulates_and_resets(tmp_path):
+    async def run():
+        store = _store(tmp_path)
+        store.set_unfolded(-4, 3)
+        await store.flush()
+        # Сообщения, пришедшие без контекста в памяти, прибавляются к сохранённому счёту
+        store.add_unfolded(-4)
+        store.add_unfolded(-4)
+        await store.flush()
+        accumulated = _unfolded(store, -4)
+        # Точное значение после сводки отменяет ещё не сброшенные прибавки
+        store.add_unfolded(-4, 4)
+        store.set_unfolded(-4, 1)
+        await store.flush()
+        reset = _unfolded(store, -4)
+        store.close()
+        return accumulated, reset
+
+    assert asyncio.run(run()) == (5, 1)
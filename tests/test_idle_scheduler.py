@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import bot
+
+
+class FakeApplication:
+    bot = None
+
+    def create_task(self, coroutine):
+        return asyncio.get_running_loop().create_task(coroutine)
+
+
+def _scheduler(delay: float, fired: list):
+    async def action(_bot, chat_id):
+        fired.append((chat_id, time.time()))
+
+    scheduler = bot.IdleScheduler()
+    scheduler.add_action(delay, action)
+    return scheduler
+
+
+def test_activity_pushes_deadline_back():
+    fired = []
+
+    async def run():
+        scheduler = _scheduler(0.2, fired)
+        scheduler.start(FakeApplication())
+        started = time.time()
+        scheduler.touch(-1, started)
+        await asyncio.sleep(0.1)
+        scheduler.touch(-1, time.time())
+        await asyncio.sleep(0.15)
+        # Старый дедлайн прошёл, но чат ожил: действие перенесено
+        assert fired == []
+        await asyncio.sleep(0.15)
+        await scheduler.stop()
+        return started
+
+    started = asyncio.run(run())
+    assert len(fired) == 1
+    assert fired[0][1] - started >= 0.3
+    assert fired[0][0] == -1
+
+
+def test_each_chat_fires_once_and_forget_cancels():
+    fired = []
+
+    async def run():
+        scheduler = _scheduler(0.05, fired)
+        scheduler.start(FakeApplication())
+        now = time.time()
+        for chat_id in (-1, -2, -3):
+            scheduler.touch(chat_id, now)
+            scheduler.touch(chat_id, now)
+        scheduler.forget(-3)
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return scheduler.pending_count
+
+    assert asyncio.run(run()) == 0
+    assert sorted(chat_id for chat_id, _ in fired) == [-2, -1]
+
+
+def test_restore_skips_deadlines_missed_while_down():
+    fired = []
+    scheduler = _scheduler(60, fired)
+    scheduler.restore(-1, time.time() - 120)
+    scheduler.restore(-2, time.time())
+    assert scheduler.pending_count == 1
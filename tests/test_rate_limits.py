@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+from bot import Priority
+
+
+def test_limiter_serves_waiters_by_priority():
+    async def run():
+        bucket = bot.TokenBucket(rate=20, capacity=1)
+        limiter = bot.PriorityLimiter()
+        costs = [(bucket, 1)]
+        order = []
+
+        async def acquire(name, priority):
+            assert await limiter.acquire(costs, priority)
+            order.append(name)
+
+        # Корзина пуста после первого запроса: остальные встают в очередь
+        await acquire("first", Priority.COMMAND)
+        background = asyncio.create_task(acquire("background", Priority.BACKGROUND))
+        await asyncio.sleep(0)
+        command = asyncio.create_task(acquire("command", Priority.COMMAND))
+        await asyncio.sleep(0)
+        mention = asyncio.create_task(acquire("mention", Priority.MENTION))
+        await asyncio.gather(background, command, mention)
+        return order
+
+    assert asyncio.run(run()) == ["first", "mention", "command", "background"]
+
+
+def test_limiter_keeps_fifo_within_priority():
+    async def run():
+        bucket = bot.TokenBucket(rate=50, capacity=1)
+        limiter = bot.PriorityLimiter()
+        order = []
+
+        async def acquire(name):
+            await limiter.acquire([(bucket, 1)], Priority.COMMAND)
+            order.append(name)
+
+        tasks = []
+        for name in range(5):
+            tasks.append(asyncio.create_task(acquire(name)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
+
+
+def test_background_dropped_when_quota_does_not_free_up(monkeypatch):
+    monkeypatch.setitem(bot.PRIORITY_MAX_WAIT, Priority.BACKGROUND, 0.05)
+
+    async def run():
+        bucket = bot.TokenBucket(rate=1, capacity=1)
+        limiter = bot.PriorityLimiter()
+        costs = [(bucket, 1)]
+        assert await limiter.acquire(costs, Priority.COMMAND)
+        dropped = not await limiter.acquire(costs, Priority.BACKGROUND)
+        # Отброшенный запрос не должен держать очередь для следующих
+        bucket.take(-1)
+        served = await asyncio.wait_for(limiter.acquire(costs, Priority.MENTION), 1)
+        return dropped, served
+
+    assert asyncio.run(run()) == (True, True)
+
+
+def test_edit_skipped_instead_of_waiting():
+    async def run():
+        bucket = bot.TokenBucket(rate=1, capacity=1)
+        limiter = bot.PriorityLimiter()
+        assert await limiter.acquire([(bucket, 1)], Priority.EDIT)
+        return await limiter.acquire([(bucket, 1)], Priority.EDIT)
+
+    assert asyncio.run(run()) is False
+
+
+def test_idle_chat_limiters_are_pruned(monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_GROUP_PER_MINUTE", 6000)
+    monkeypatch.setattr(bot, "TELEGRAM_LIMITER_PRUNE_MIN", 4)
+
+    async def ok():
+        return True
+
+    async def flood():
+        raise RetryAfter(120)
+
+    async def send(limiter, chat_id, callback=ok):
+        return await limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": chat_id}, Priority.BACKGROUND)
+
+    async def run():
+        limiter = bot.TelegramRateLimiter()
+        for chat_id in (-1, -2, -3):
+            await send(limiter, chat_id)
+        with pytest.raises(RetryAfter):
+            await send(limiter, -4, flood)
+        # Корзины свободных групп успевают наполниться
+        await asyncio.sleep(0.05)
+        await send(limiter, -5)
+        return set(limiter._chats)
+
+    # Группа на паузе после RetryAfter остаётся, чтобы пауза не потерялась
+    assert asyncio.run(run()) == {-4, -5}
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import NetworkError
+
+import bot
+
+
+class FakeChat:
+    async def send_action(self, action):
+        raise NetworkError("connection reset")
+
+
+class FakeMessage:
+    chat = FakeChat()
+
+    async def reply_text(self, text):
+        self.replied = text
+
+
+def test_reservation_returned_when_reply_fails_before_request():
+    model = bot.model_router.primary
+    pool = bot.ResponsePool("test", "Расскажи что-нибудь", size=0)
+
+    async def run():
+        with pytest.raises(NetworkError):
+            await bot.reply_from_pool(FakeMessage(), -301, pool)
+        return model.request_bucket.full
+
+    assert asyncio.run(run())
+
+
+def test_fallback_reply_is_not_marked_served(monkeypatch):
+    async def fallback(message, chat_id, **kwargs):
+        return bot.GROQ_ERROR_REPLY
+
+    monkeypatch.setattr(bot, "reply_with_groq", fallback)
+    monkeypatch.setattr(FakeChat, "send_action", lambda self, action: asyncio.sleep(0))
+    pool = bot.ResponsePool("test", "Расскажи что-нибудь", size=0)
+    asyncio.run(bot.reply_from_pool(FakeMessage(), -302, pool))
+    assert not pool.recent
+
+
+def test_pool_answer_is_served_once():
+    pool = bot.ResponsePool("test", "Расскажи что-нибудь", size=0)
+    pool.items.append((time.time(), "Колобок повесился."))
+    message = FakeMessage()
+    asyncio.run(bot.reply_from_pool(message, -303, pool))
+    assert message.replied == "Колобок повесился."
+    assert pool.take() is None
+    assert len(pool.recent) == 1
+
+
+def _same(pool, a, b):
+    return pool._same(pool._key(a), pool._key(b))
+
+
+def test_movie_repeats_found_by_title():
+    pool = bot.ResponsePool("movie", "Посоветуй фильм", size=0, titled=True)
+    first = "Братан, зацени «Начало» Нолана — мозг взрывает!"
+    # Тот же фильм другими словами и в других кавычках
+    assert _same(pool, first, 'Слушай, посмотри "Начало" (2010), там сны во снах.')
+    assert _same(pool, "Глянь «Оно» — жуть.", "Пересмотри «ОНО», ё-моё")
+    # Общие слова вокруг названия не делают разные фильмы повтором
+    assert not _same(pool, first, "Братан, зацени «Довод» Нолана — мозг взрывает!")
+
+
+def test_untitled_repeats_found_by_shared_words():
+    pool = bot.ResponsePool("joke", "Расскажи шутку", size=0)
+    joke = "Штирлиц шёл по лесу и увидел голубые ели. Присмотрелся — голубые не только ели, но и пили."
+    retold = "Короче, Штирлиц шел по лесу, увидел голубые ели. Присмотрелся: голубые не только ели, но и пили!"
+    other = "Приходит мужик к врачу, а врач ему говорит: вы кто такой?"
+    assert _same(pool, joke, retold)
+    assert not _same(pool, joke, other)
+
+
+def test_take_skips_recently_served_repeat():
+    pool = bot.ResponsePool("movie", "Посоветуй фильм", size=0, titled=True)
+    pool.mark_served("Зацени «Матрицу», классика!")
+    now = time.time()
+    pool.items.extend([(now, 'Пересмотри "матрицу" — не пожалеешь.'), (now, "Глянь «Бойцовский клуб».")])
+    assert pool.take() == "Глянь «Бойцовский клуб»."
+    assert pool.take() is None
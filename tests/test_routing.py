@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import bot
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = bot.CircuitBreaker(threshold=2, cooldown=0.05)
+    assert not breaker.failure()
+    assert breaker.failure()
+    assert breaker.is_open and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.ready
+    assert breaker.allow()
+    # Пока идёт проба, остальные запросы не пропускаются
+    assert not breaker.ready and not breaker.allow()
+
+    breaker.success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_breaker_reopens_when_probe_fails():
+    breaker = bot.CircuitBreaker(threshold=1, cooldown=0.05)
+    assert breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.failure()
+    assert breaker.is_open and not breaker.allow()
+
+
+def test_abandoned_probe_lets_next_request_through():
+    breaker = bot.CircuitBreaker(threshold=1, cooldown=0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def _router(latency: float = 0.05):
+    large, small = bot.GroqModel("large", None), bot.GroqModel("small", None)
+    for _ in range(bot.LATENCY_MIN_SAMPLES):
+        large.record_latency("complete", latency)
+    return bot.ModelRouter([large, small]), large, small
+
+
+def test_hedge_fires_after_percentile_delay_and_cancels_loser(monkeypatch):
+    monkeypatch.setattr(bot, "HEDGE_MIN_DELAY", 0.01)
+    router, large, small = _router(latency=0.1)
+    launched = []
+    cancelled = []
+
+    async def attempt(model):
+        if model is large:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(model)
+                raise
+        return model.name
+
+    async def run():
+        started = time.monotonic()
+        model, result = await router.race(attempt, "complete", hedge=True, on_launch=launched.append)
+        return model, result, time.monotonic() - started
+
+    model, result, elapsed = asyncio.run(run())
+    assert (model, result) == (small, "small")
+    assert large.hedge_delay("complete") == 0.1
+    assert 0.1 <= elapsed < 1
+    assert launched == [large, small]
+    assert cancelled == [large]
+
+
+def test_no_hedge_when_primary_answers_in_time(monkeypatch):
+    monkeypatch.setattr(bot, "HEDGE_MIN_DELAY", 0.01)
+    router, large, small = _router(latency=0.2)
+    launched = []
+
+    async def attempt(model):
+        await asyncio.sleep(0.01)
+        return model.name
+
+    model, _ = asyncio.run(router.race(attempt, "complete", hedge=True, on_launch=launched.append))
+    assert model is large
+    assert launched == [large]
+
+
+def test_open_breaker_moves_primary_to_fallback():
+    router, large, small = _router()
+    for _ in range(large.breaker.threshold):
+        large.breaker.failure()
+    assert router.primary is small
+
+    async def attempt(model):
+        return model.name
+
+    model, _ = asyncio.run(router.race(attempt, "complete", hedge=False, first=router.primary))
+    assert model is small
+
+
+def test_hedge_is_charged_to_its_own_model():
+    router, large, small = _router()
+    reservation = bot.GroqReservation(large, 100)
+    before = large.token_bucket.tokens, small.token_bucket.tokens
+    reservation.charge(large)
+    reservation.charge(small)
+    assert large.token_bucket.tokens >= before[0]
+    assert small.token_bucket.tokens <= before[1] - 100
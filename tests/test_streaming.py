@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest
+
+import bot
+from bot import Role
+
+
+class FakeBot:
+    """Записывает отправки и правки; правки можно заставить падать, как при удалённом сообщении."""
+
+    def __init__(self, fail_edits: bool = False):
+        self.fail_edits = fail_edits
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return FakeMessage(self, chat_id, len(self.sent))
+
+    async def edit_message_text(self, text, **kwargs):
+        if self.fail_edits:
+            raise BadRequest("Message to edit not found")
+        self.edits.append(text)
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id, message_id):
+        self._bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    def get_bot(self):
+        return self._bot
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0)
+
+    def use(chunks, error=None):
+        async def fake_stream(*args, **kwargs):
+            for chunk in chunks:
+                await asyncio.sleep(0)
+                yield chunk
+            if error is not None:
+                raise error
+
+        monkeypatch.setattr(bot, "groq_stream", fake_stream)
+
+    return use
+
+
+def _reply(fake_bot, chat_id):
+    async def run():
+        text = await bot.stream_groq_reply(FakeMessage(fake_bot, chat_id, 0), chat_id)
+        return text, [m.text for m in await bot.get_context(chat_id)]
+
+    return asyncio.run(run())
+
+
+def test_complete_stream_is_edited_in_place_and_remembered(stream):
+    stream(["Здорово, ", "братва", "!"])
+    fake_bot = FakeBot()
+    text, history = _reply(fake_bot, -201)
+    assert text == "Здорово, братва!"
+    assert fake_bot.sent == ["Здорово, "]
+    assert fake_bot.edits[-1] == "Здорово, братва!"
+    assert history[-1] == "Здорово, братва!"
+
+
+def test_telegram_failure_does_not_cut_the_groq_stream(stream):
+    stream(["Раз, ", "два, ", "три."])
+    fake_bot = FakeBot(fail_edits=True)
+    text, history = _reply(fake_bot, -202)
+    # Правка упала, но поток дочитан, а итог отправлен новым сообщением
+    assert text == "Раз, два, три."
+    assert fake_bot.sent == ["Раз, ", "Раз, два, три."]
+    assert history[-1] == "Раз, два, три."
+
+
+def test_broken_groq_stream_is_marked_and_not_remembered(stream):
+    stream(["Значит так, ", "слушай"], error=ConnectionError("reset"))
+    fake_bot = FakeBot()
+    text, history = _reply(fake_bot, -203)
+    assert text == "Значит так, слушай" + bot.STREAM_TRUNCATED_MARK
+    assert fake_bot.edits[-1] == text
+    assert history == []
+
+
+def test_empty_stream_sends_fallback(stream):
+    stream([], error=ConnectionError("reset"))
+    fake_bot = FakeBot()
+    text, history = _reply(fake_bot, -204)
+    assert text == bot.GROQ_ERROR_REPLY
+    assert fake_bot.sent == [bot.GROQ_ERROR_REPLY]
+    assert history == []
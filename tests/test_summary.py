@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+from bot import ChatMessage, Role
+
+
+@pytest.fixture(autouse=True)
+def fold_settings(monkeypatch):
+    monkeypatch.setattr(bot, "SUMMARY_FOLD_TOKENS", 20)
+    monkeypatch.setattr(bot, "SUMMARY_MIN_INTERVAL", 30)
+    monkeypatch.setattr(bot, "SUMMARY_MAX_DELAY", 600)
+
+
+def _context(count: int, start: int = 0) -> bot.ChatContext:
+    context = bot.ChatContext(token_budget=40)
+    _fill(context, count, start)
+    # Последняя сводка была давно: интервал между сворачиваниями не мешает
+    context.folded_at = time.monotonic() - 60
+    return context
+
+
+def _fill(context, count: int, start: int = 0):
+    for i in range(start, start + count):
+        context.append(ChatMessage(Role.USER, f"сообщение номер {i} про футбол", "Петя"))
+
+
+def test_fold_waits_for_a_batch():
+    context = bot.ChatContext(token_budget=40)
+    _fill(context, 3)
+    assert context.evicted and context.evicted_tokens < bot.SUMMARY_FOLD_TOKENS
+    # Мало вытеснено и недавно сворачивали — ждём
+    assert not context.summary_due()
+    _fill(context, 10, start=3)
+    assert context.evicted_tokens >= bot.SUMMARY_FOLD_TOKENS
+    assert not context.summary_due()
+    context.folded_at -= bot.SUMMARY_MIN_INTERVAL
+    assert context.summary_due()
+
+
+def test_small_tail_folds_after_max_delay():
+    context = bot.ChatContext(token_budget=40)
+    _fill(context, 3)
+    context.folded_at -= bot.SUMMARY_MAX_DELAY
+    assert context.summary_due()
+
+
+def test_evicted_batch_is_folded_in_one_request(monkeypatch):
+    context = _context(12)
+    evicted = [m.text for m in context.evicted]
+    requests = []
+
+    async def fake_complete(messages, **kwargs):
+        requests.append(messages[-1]["content"])
+        return "Петя весь вечер говорил про футбол"
+
+    monkeypatch.setattr(bot, "groq_complete", fake_complete)
+    context.summarizing = True
+    asyncio.run(bot.refresh_summary(-401, context))
+
+    assert len(requests) == 1
+    assert all(text in requests[0] for text in evicted)
+    assert context.summary == "Петя весь вечер говорил про футбол"
+    assert context.evicted == [] and context.evicted_tokens == 0
+    assert not context.summarizing
+    assert bot.chat_store._summaries[-401] == context.summary
+    assert bot.chat_store._unfolded[-401] == 0
+
+
+def test_failed_fold_restores_messages_in_order(monkeypatch):
+    context = _context(12)
+    evicted = list(context.evicted)
+
+    async def failing_complete(messages, **kwargs):
+        # Пока сводка в работе, чат продолжает писать и вытесняет ещё сообщения
+        _fill(context, 5, start=100)
+        raise RuntimeError("groq is down")
+
+    monkeypatch.setattr(bot, "groq_complete", failing_complete)
+    context.summarizing = True
+    asyncio.run(bot.refresh_summary(-402, context))
+
+    assert context.summary == ""
+    assert context.evicted[:len(evicted)] == evicted
+    assert len(context.evicted) == len(evicted) + 5
+    assert context.evicted_tokens == sum(m.tokens for m in context.evicted)
+    assert not context.summarizing
+    # Следующая попытка — не раньше интервала, а не сразу же
+    assert not context.summary_due()
+
+
+def test_cancelled_fold_keeps_messages(monkeypatch):
+    context = _context(12)
+    evicted = list(context.evicted)
+
+    async def slow_complete(messages, **kwargs):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(bot, "groq_complete", slow_complete)
+
+    async def run():
+        context.summarizing = True
+        task = asyncio.create_task(bot.refresh_summary(-403, context))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert context.evicted == evicted
+    assert not context.summarizing
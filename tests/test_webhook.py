@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Bot
+
+import bot
+
+SECRET = "s3cret-token"
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = Bot("123:test")
+        self.update_queue = asyncio.Queue()
+
+
+def _update(update_id: int = 1) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": 10,
+            "date": 1700000000,
+            "chat": {"id": -100, "type": "group", "title": "test"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Tester"},
+            "text": "привет",
+        },
+    }
+
+
+def _post(monkeypatch, body, headers):
+    """POST на webhook_handler через настоящий aiohttp-сервер; возвращает статус и очередь апдейтов."""
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+
+    async def run():
+        application = FakeApplication()
+        async with TestClient(TestServer(bot.build_webhook_app(application))) as client:
+            response = await client.post(bot.WEBHOOK_PATH, data=body, headers=headers)
+            return response.status, application.update_queue
+
+    return asyncio.run(run())
+
+
+def test_valid_update_is_queued(monkeypatch):
+    status, queue = _post(monkeypatch, json.dumps(_update(7)), {"X-Telegram-Bot-Api-Secret-Token": SECRET})
+    assert status == 200
+    update = queue.get_nowait()
+    assert update.update_id == 7
+    assert update.message.text == "привет"
+
+
+def test_wrong_or_missing_secret_is_forbidden(monkeypatch):
+    for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}):
+        status, queue = _post(monkeypatch, json.dumps(_update()), headers)
+        assert status == 403
+        assert queue.empty()
+
+
+def test_non_ascii_secret_is_forbidden(monkeypatch):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "секрет".encode().decode("latin-1")}
+    status, queue = _post(monkeypatch, json.dumps(_update()), headers)
+    assert status == 403
+    assert queue.empty()
+
+
+def test_malformed_body_is_rejected(monkeypatch):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    for body in ("not json", json.dumps("x"), json.dumps([1, 2]), json.dumps({"update_id": "oops", "message": 5})):
+        status, queue = _post(monkeypatch, body, headers)
+        assert status == 400, body
+        assert queue.empty()